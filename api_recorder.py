@@ -0,0 +1,139 @@
+import os
+import json
+import time
+from file_storage import atomic_write_text, read_jsonl, append_jsonl
+
+# Record / replay layer around the spotipy client, chosen with api_mode in update_dynamic_playlist.py:
+#   'record' -- calls Spotify as usual, and saves every response (and every playlist write) to the
+#               api_recordings folder of the storage location. Each record run starts a fresh recording.
+#   'replay' -- runs entirely offline from the last recording. Responses come from the recording, and playlist
+#               writes are saved to captured_writes.jsonl instead of being sent. No login is needed.
+#   'ttl'    -- development loops: read requests are answered from a local cache while it is younger than
+#               api_ttl_seconds, and from Spotify otherwise. Writes are sent as usual.
+# Any other value (None) uses the spotipy client directly.
+recordings_dirname = 'api_recordings'
+recordings_filename = 'recordings.jsonl'
+captured_writes_filename = 'captured_writes.jsonl'
+ttl_cache_filename = 'ttl_cache.jsonl'
+
+write_methods = {'playlist_replace_items', 'playlist_add_items', 'playlist_remove_all_occurrences_of_items',
+                 'playlist_remove_specific_occurrences_of_items', 'playlist_reorder_items'}
+read_methods = {'playlist_tracks', 'playlist_items', 'next', 'current_user_recently_played', 'audio_features',
+                'current_user', 'playlist', 'track', 'tracks'}
+
+# A 'before' timestamp this close to the time of the request means "the latest plays", and is keyed as such so
+# that a later run asking for its own latest plays finds the recording.
+latest_plays_tolerance_ms = 60000
+# Requests keyed on a timestamp, which a replay run may ask for with a different one. All other requests must
+# match their recording exactly.
+time_keyed_methods = {'current_user_recently_played'}
+
+
+class ReplayMissingError(Exception):
+    pass
+
+
+def request_key(method_name, args, kwargs, request_ms):
+    # Canonical key for a request. Paging (next) is keyed on the url of the page being requested.
+    if method_name == 'next' and args and isinstance(args[0], dict):
+        args = (args[0].get('next'),)
+    if method_name == 'current_user_recently_played' and kwargs.get('before') is not None:
+        if abs(request_ms - kwargs['before']) <= latest_plays_tolerance_ms:
+            kwargs = dict(kwargs, before='latest')
+    return method_name + ' ' + json.dumps([list(args), kwargs], sort_keys=True, default=str)
+
+
+class RecordingClient:
+    # Stands in for the spotipy client. Every method the pipeline calls goes through call().
+    def __init__(self, sp, storage_filepath, mode, ttl_seconds=3600):
+        self.sp = sp
+        self.mode = mode
+        self.ttl_seconds = ttl_seconds
+        recordings_dir = os.path.join(storage_filepath, recordings_dirname)
+        os.makedirs(recordings_dir, exist_ok=True)
+        self.recordings_file = os.path.join(recordings_dir, recordings_filename)
+        self.writes_file = os.path.join(recordings_dir, captured_writes_filename)
+        self.ttl_file = os.path.join(recordings_dir, ttl_cache_filename)
+
+        if mode == 'record':
+            atomic_write_text(self.recordings_file, '')
+            atomic_write_text(self.writes_file, '')
+        elif mode == 'replay':
+            atomic_write_text(self.writes_file, '')
+            self.load_recordings(read_jsonl(self.recordings_file))
+        elif mode == 'ttl':
+            # Latest cached response per key. Expired entries are dropped from the file on load.
+            cutoff_ms = int(time.time() * 1000) - ttl_seconds * 1000
+            self.ttl_cache = {entry['key']: entry for entry in read_jsonl(self.ttl_file)
+                              if entry['requested_at'] >= cutoff_ms}
+            atomic_write_text(self.ttl_file, ''.join(json.dumps(entry, default=str) + '\n'
+                                                     for entry in self.ttl_cache.values()))
+
+    def load_recordings(self, recordings):
+        # Replay answers a request with the first unused recording of the same request, or failing that, for
+        # time-keyed requests (a page requested with a different timestamp), the next unused recording of the same
+        # method.
+        self.recordings = recordings
+        self.used = [False] * len(recordings)
+        self.by_key = {}
+        self.by_method = {}
+        for position, entry in enumerate(recordings):
+            self.by_key.setdefault(entry['key'], []).append(position)
+            self.by_method.setdefault(entry['method'], []).append(position)
+        print(len(recordings), 'recorded API responses loaded for replay.')
+
+    def replay(self, method_name, key):
+        candidate_lists = [self.by_key.get(key, [])]
+        if method_name in time_keyed_methods:
+            candidate_lists.append(self.by_method.get(method_name, []))
+        for candidates in candidate_lists:
+            for position in candidates:
+                if not self.used[position]:
+                    self.used[position] = True
+                    return self.recordings[position]['response']
+        raise ReplayMissingError('No recorded response left for ' + key
+                                 + '. The run asked for something the recording does not have; record it again.')
+
+    def __getattr__(self, method_name):
+        return lambda *args, **kwargs: self.call(method_name, *args, **kwargs)
+
+    def call(self, method_name, *args, **kwargs):
+        request_ms = int(time.time() * 1000)
+        key = request_key(method_name, args, kwargs, request_ms)
+        entry = {'key': key, 'method': method_name, 'requested_at': request_ms}
+
+        if method_name in write_methods:
+            if self.mode == 'replay':
+                append_jsonl(self.writes_file, dict(entry, args=args, kwargs=kwargs))
+                return {'snapshot_id': 'replay'}
+            response = getattr(self.sp, method_name)(*args, **kwargs)
+            if self.mode == 'record':
+                append_jsonl(self.writes_file, dict(entry, args=args, kwargs=kwargs))
+            return response
+
+        if self.mode == 'replay':
+            return self.replay(method_name, key)
+
+        if self.mode == 'ttl' and method_name in read_methods:
+            cached = self.ttl_cache.get(key)
+            if cached is not None and request_ms - cached['requested_at'] < self.ttl_seconds * 1000:
+                return cached['response']
+            response = getattr(self.sp, method_name)(*args, **kwargs)
+            entry['response'] = response
+            self.ttl_cache[key] = entry
+            append_jsonl(self.ttl_file, entry)
+            return response
+
+        response = getattr(self.sp, method_name)(*args, **kwargs)
+        if self.mode == 'record':
+            entry['response'] = response
+            append_jsonl(self.recordings_file, entry)
+        return response
+
+
+def api_client(sp, storage_filepath, mode=None, ttl_seconds=3600):
+    # Wraps the logged-in client (None when replaying) for the chosen api_mode.
+    if mode not in ('record', 'replay', 'ttl'):
+        return sp
+    print('Spotify API mode:', mode)
+    return RecordingClient(sp, storage_filepath, mode, ttl_seconds)
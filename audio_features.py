@@ -0,0 +1,74 @@
+import os
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pytz
+from file_storage import atomic_to_csv, atomic_write_json, read_json
+import spotify_functions as sf
+
+# Audio features never change for a given track id, so they are cached locally forever. Tracks Spotify has
+# no features for are cached too (with blank values) so they are not requested again on every run.
+feature_columns = ['track_id', 'tempo', 'energy']
+# Newer Spotify developer apps are refused the audio-features endpoint (403). After a refusal no feature requests
+# are made for refusal_backoff_days; delete audio_features_refused.json to try again sooner.
+refusal_filename = 'audio_features_refused.json'
+refusal_backoff_days = 7
+
+
+def read_audio_features(storage_filepath):
+    # Returns the local feature cache as a dataframe, empty if nothing has been cached yet.
+    features_fn = os.path.join(storage_filepath, 'audio_features.csv')
+    if not os.path.exists(features_fn):
+        return pd.DataFrame(columns=feature_columns)
+    return pd.read_csv(features_fn)
+
+
+def update_audio_features(sp, storage_filepath, batch_size=100):
+    # Fetches tempo and energy for any tracked song missing from the local feature cache.
+    # sp only needs an audio_features(track_ids) method, so a local stand-in can be used in place of the API.
+    sf.print_break()
+    tracked_df = pd.read_csv(os.path.join(storage_filepath, 'all_tracked_songs.csv'))
+    features_df = read_audio_features(storage_filepath)
+    known_ids = set(features_df['track_id'])
+    missing_ids = [track_id for track_id in tracked_df['track_id'].dropna().unique() if track_id not in known_ids]
+
+    if not missing_ids:
+        print('Audio features already cached for all', len(tracked_df), 'tracked songs.')
+        return 0
+
+    refusal_fn = os.path.join(storage_filepath, refusal_filename)
+    refusal = read_json(refusal_fn)
+    now = datetime.now(pytz.UTC)
+    retry_at = datetime.fromisoformat(refusal['refused_at']) + timedelta(days=refusal_backoff_days) if refusal else now
+    if now < retry_at:
+        print('Spotify refused the audio features request on', refusal['refused_at'][:10] + '.',
+              'Not requesting features for', len(missing_ids), 'songs until', retry_at.date())
+        return 0
+
+    print('Retrieving audio features for', len(missing_ids), 'songs.')
+    new_rows = []
+    for i in range(0, len(missing_ids), batch_size):
+        batch = missing_ids[i:i + batch_size]
+        try:
+            results = sp.audio_features(batch)
+        except Exception as e:
+            # Keep whatever was retrieved so far; the rest will be requested on the next run, or after the
+            # back-off if Spotify refused access.
+            print('Unable to retrieve audio features:', e)
+            if getattr(e, 'http_status', None) == 403:
+                atomic_write_json(refusal_fn, {'refused_at': now.isoformat(timespec='seconds'), 'error': str(e)})
+                print('Audio features will not be requested again for', refusal_backoff_days, 'days.')
+            break
+
+        for track_id, features in zip(batch, results):
+            if features is None:
+                new_rows.append({'track_id': track_id, 'tempo': np.nan, 'energy': np.nan})
+            else:
+                new_rows.append({'track_id': track_id, 'tempo': features['tempo'], 'energy': features['energy']})
+
+    if new_rows:
+        features_df = pd.concat([features_df, pd.DataFrame(new_rows, columns=feature_columns)], ignore_index=True)
+        features_fn = os.path.join(storage_filepath, 'audio_features.csv')
+        atomic_to_csv(features_df[feature_columns], features_fn)
+        print(len(new_rows), 'songs added to the audio feature cache at', features_fn)
+    return len(new_rows)
@@ -0,0 +1,116 @@
+import sys
+import time
+import tracemalloc
+import pandas as pd
+from spotify_functions import TrackColumns, playlist_columns
+
+# Compares parsing API pages into a dataframe with one dict per track (the previous approach) against the
+# TrackColumns column builders now used by synchronize_playlist and get_recently_played.
+# Run with: python benchmark_track_parsing.py [number of tracks]
+
+play_columns = ['track_name', 'artist_name', 'album_name', 'played_at', 'played_at_timestamp', 'duration_ms',
+                'track_id', 'popularity', 'meta_batch', 'is_tracked_song', 'played_on_tracked_list']
+
+
+def synthetic_pages(num_tracks, page_size=100):
+    # Pages shaped like the playlist_tracks / current_user_recently_played responses.
+    pages = []
+    for start in range(0, num_tracks, page_size):
+        items = []
+        for number in range(start, min(start + page_size, num_tracks)):
+            items.append({'played_at': '2024-05-01T10:%02d:%02d.000Z' % (number // 60 % 60, number % 60),
+                          'track': {'id': 'track%06d' % number,
+                                    'name': 'Song ' + str(number),
+                                    'popularity': number % 100,
+                                    'duration_ms': 180000 + number,
+                                    'album': {'id': 'album%05d' % (number // 12), 'name': 'Album ' + str(number // 12)},
+                                    'artists': [{'id': 'artist%04d' % (number // 40),
+                                                 'name': 'Artist ' + str(number // 40)}]}})
+        pages.append(items)
+    return pages
+
+
+def dict_playlist(pages):
+    track_data = []
+    for items in pages:
+        for item in items:
+            if item['track'] is None:
+                continue
+            track = item['track']
+            track_data.append({
+                'album_id': track['album']['id'],
+                'album_name': track['album']['name'],
+                'artist_id': track['artists'][0]['id'] if track['artists'] else None,
+                'artist_name': track['artists'][0]['name'] if track['artists'] else None,
+                'track_id': track['id'],
+                'track_name': track['name'],
+                'popularity': track['popularity'],
+                'duration_ms': track['duration_ms']})
+    return pd.DataFrame(track_data)
+
+
+def column_playlist(pages):
+    track_columns = TrackColumns()
+    for items in pages:
+        track_columns.add_playlist_items(items)
+    return track_columns.to_dataframe(playlist_columns)
+
+
+def dict_plays(pages):
+    all_tracks = []
+    for batch, items in enumerate(pages, start=1):
+        for position, item in enumerate(items):
+            track = item['track']
+            all_tracks.append({
+                'track_name': track['name'],
+                'artist_name': track['artists'][0]['name'],
+                'album_name': track['album']['name'],
+                'played_at': item['played_at'],
+                'played_at_timestamp': position,
+                'duration_ms': track['duration_ms'],
+                'track_id': track['id'],
+                'popularity': track['popularity'],
+                'meta_batch': batch,
+                'is_tracked_song': False,
+                'played_on_tracked_list': False})
+    return pd.DataFrame(all_tracks, columns=play_columns)
+
+
+def column_plays(pages):
+    track_columns = TrackColumns()
+    for batch, items in enumerate(pages, start=1):
+        for position, item in enumerate(items):
+            track_columns.add_play(item['track'], item['played_at'], position, batch)
+    return track_columns.to_dataframe(play_columns, is_tracked_song=False, played_on_tracked_list=False)
+
+
+def measure(parse, pages, repeats=5):
+    # Best wall time of several runs, and the peak memory of one run.
+    best_seconds = min(timed(parse, pages) for _ in range(repeats))
+    tracemalloc.start()
+    parse(pages)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best_seconds, peak_bytes
+
+
+def timed(parse, pages):
+    start_time = time.perf_counter()
+    parse(pages)
+    return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    num_tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    pages = synthetic_pages(num_tracks)
+    pd.testing.assert_frame_equal(dict_playlist(pages), column_playlist(pages))
+    pd.testing.assert_frame_equal(dict_plays(pages), column_plays(pages))
+
+    print('Parsing', num_tracks, 'tracks (best of 5, peak traced memory):')
+    for label, dict_parse, column_parse in [('playlist', dict_playlist, column_playlist),
+                                            ('recently played', dict_plays, column_plays)]:
+        dict_seconds, dict_peak = measure(dict_parse, pages)
+        column_seconds, column_peak = measure(column_parse, pages)
+        print(' ', label)
+        print('    dicts:   ', str(round(dict_seconds * 1000, 1)) + ' ms,', round(dict_peak / 1048576, 2), 'MB')
+        print('    columns: ', str(round(column_seconds * 1000, 1)) + ' ms,', round(column_peak / 1048576, 2), 'MB')
@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_open(filename):
+    # Opens a temporary file next to the target for writing, and renames it over the target once the
+    # write completes. A crash or Ctrl-C mid-write leaves the previous file untouched instead of half-written.
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, filename)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+def atomic_to_csv(df, filename, index=False):
+    # Crash-safe replacement for df.to_csv(filename)
+    with atomic_open(filename) as f:
+        df.to_csv(f, index=index)
+
+
+def atomic_write_text(filename, text):
+    # Crash-safe replacement for writing a small text file (credentials, playlist ids).
+    with atomic_open(filename) as f:
+        f.write(text)
+
+
+def atomic_write_json(filename, data):
+    with atomic_open(filename) as f:
+        json.dump(data, f)
+
+
+def read_json(filename, default=None):
+    # Returns the parsed contents of a json file, or the default if it does not exist or cannot be read.
+    if not os.path.exists(filename):
+        return default
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print('Unable to read', filename, ':', e)
+        return default
+
+
+def read_jsonl(filename):
+    # Reads one json object per line. A partly written last line (interrupted run) is ignored.
+    entries = []
+    if not os.path.exists(filename):
+        return entries
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return entries
+
+
+def append_jsonl(filename, entry):
+    # Appends one json object as a line. If an interrupted append left a partial line, it is ended first so the
+    # new entry stays readable.
+    with open(filename, 'a+b') as f:
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.write((json.dumps(entry, default=str, separators=(',', ':')) + '\n').encode('utf-8'))
+        f.flush()
+
+
+def file_fingerprint(filename):
+    # Returns a sha256 hash of a file's contents, or an empty string if the file does not exist.
+    if not os.path.exists(filename):
+        return ''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,151 @@
+import os
+import sys
+import shutil
+from datetime import datetime
+from file_storage import atomic_write_text, atomic_write_json
+
+# After every pipeline stage, the data files of the storage location are published as a numbered, read-only
+# generation in generations/<n>/, and generations/CURRENT is switched to it in one atomic rename. Readers (the stats
+# service, the shuffle audit, or you in Excel) open the files of the current generation, and keep a consistent
+# set of files while the pipeline goes on writing the next one. Nothing in a published generation is ever
+# written to again.
+# Outside Windows, generations are hard links to the working files, so publishing costs no disk space or copying: the
+# pipeline always replaces its files with a new one (atomic rename), which leaves the linked copy untouched. On
+# Windows a file open in Excel locks every hard link to it, so a generation must never share a file with the working
+# copy: changed files are copied, and unchanged files are hard links to the previous generation's copy, which the
+# pipeline never replaces.
+# The pipeline also holds an advisory lock on the storage location, so two runs cannot write to it at once.
+generations_dirname = 'generations'
+current_filename = 'CURRENT'
+manifest_filename = 'manifest.json'
+keep_generations = 5
+# Never fewer than 2: a reader may have just resolved CURRENT to the generation before the one being published.
+lock_filename = 'pipeline.lock'
+link_working_files = os.name != 'nt'
+
+
+def generations_path(storage_filepath):
+    return os.path.join(storage_filepath, generations_dirname)
+
+
+def current_generation(storage_filepath):
+    # Number of the current generation, or None if nothing has been published yet.
+    try:
+        with open(os.path.join(generations_path(storage_filepath), current_filename), 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def current_generation_path(storage_filepath):
+    generation = current_generation(storage_filepath)
+    if generation is None:
+        return None
+    return os.path.join(generations_path(storage_filepath), str(generation))
+
+
+def generation_file(storage_filepath, filename, generation_path=None):
+    # Path of a data file in the current (or given) generation, falling back to the working file if it has not
+    # been published.
+    generation_path = generation_path or current_generation_path(storage_filepath)
+    if generation_path is not None and os.path.exists(os.path.join(generation_path, filename)):
+        return os.path.join(generation_path, filename)
+    return os.path.join(storage_filepath, filename)
+
+
+def data_files(storage_filepath):
+    return sorted(name for name in os.listdir(storage_filepath)
+                  if name.endswith('.csv') and not name.startswith('.'))
+
+
+def same_file(path_a, path_b):
+    # True if both paths are the same hard-linked file, or an identical copy (same size & modification time).
+    try:
+        stat_a, stat_b = os.stat(path_a), os.stat(path_b)
+    except OSError:
+        return False
+    return os.path.samestat(stat_a, stat_b) or (stat_a.st_size == stat_b.st_size
+                                                  and stat_a.st_mtime_ns == stat_b.st_mtime_ns)
+
+
+def publish_generation(storage_filepath, stage_name=None):
+    # Publishes the working data files as a new generation, unless none of them changed since the current one.
+    # Returns the current generation number.
+    filenames = data_files(storage_filepath)
+    current = current_generation(storage_filepath)
+    current_path = current_generation_path(storage_filepath)
+    if current_path is not None and os.path.isdir(current_path) \
+            and sorted(name for name in os.listdir(current_path) if name != manifest_filename) == filenames \
+            and all(same_file(os.path.join(storage_filepath, name), os.path.join(current_path, name))
+                    for name in filenames):
+        return current
+
+    generation = (current or 0) + 1
+    build_path = os.path.join(generations_path(storage_filepath), '.' + str(generation) + '.tmp')
+    shutil.rmtree(build_path, ignore_errors=True)
+    os.makedirs(build_path)
+    for name in filenames:
+        working_file = os.path.join(storage_filepath, name)
+        link_source = working_file if link_working_files else None
+        if not link_working_files and current_path is not None \
+                and same_file(working_file, os.path.join(current_path, name)):
+            link_source = os.path.join(current_path, name)
+        if link_source is not None:
+            try:
+                os.link(link_source, os.path.join(build_path, name))
+                continue
+            except OSError:
+                pass
+        shutil.copy2(working_file, os.path.join(build_path, name))
+    atomic_write_json(os.path.join(build_path, manifest_filename),
+                      {'generation': generation, 'stage': stage_name, 'files': filenames,
+                       'published_at': datetime.now().isoformat(timespec='seconds')})
+
+    generation_path = os.path.join(generations_path(storage_filepath), str(generation))
+    shutil.rmtree(generation_path, ignore_errors=True)
+    os.replace(build_path, generation_path)
+    atomic_write_text(os.path.join(generations_path(storage_filepath), current_filename), str(generation))
+    prune_generations(storage_filepath, generation)
+    return generation
+
+
+def prune_generations(storage_filepath, generation):
+    # Keeps the newest keep_generations generations, and always the previous one. A generation still open by a
+    # reader on Windows cannot be removed, and is left for a later run.
+    keep = max(keep_generations, 2)
+    for name in os.listdir(generations_path(storage_filepath)):
+        if name.isdigit() and int(name) <= generation - keep:
+            shutil.rmtree(os.path.join(generations_path(storage_filepath), name), ignore_errors=True)
+
+
+def acquire_pipeline_lock(storage_filepath):
+    # Takes the advisory lock for this storage location, or stops the script if another run holds it.
+    # The lock is released by release_pipeline_lock, or by the operating system if the script dies.
+    # It is taken before anything is written, so the storage location is created here if it does not exist yet.
+    os.makedirs(storage_filepath, exist_ok=True)
+    lock_file = open(os.path.join(storage_filepath, lock_filename), 'a+')
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        print('Another run is already updating', storage_filepath)
+        print('Terminating script.')
+        sys.exit(1)
+    return lock_file
+
+
+def release_pipeline_lock(lock_file):
+    if os.name == 'nt':
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    lock_file.close()
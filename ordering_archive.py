@@ -0,0 +1,309 @@
+import os
+import sys
+from bisect import bisect_left
+from datetime import datetime
+import pandas as pd
+import pytz
+from file_storage import read_jsonl, append_jsonl, atomic_write_json, read_json
+from generations import acquire_pipeline_lock, release_pipeline_lock
+
+# Every playlist order written to Spotify is kept in ordering_archive/<playlist name>.jsonl, one version per line,
+# so a bad run can be inspected and undone. Songs are stored as numbers: each song gets the next number the first
+# time it appears in the archive, listed in the 'tracks' of that version, so a 22-character track id is written
+# once rather than in every version. Versions are stored as a delta against the version before:
+#   removed: songs no longer on the playlist
+#   placed:  [position, song] for every song that is new or moved. All other songs keep their order, and are
+#            the longest run of songs already in order, so the delta is as small as it can be.
+# or as a full snapshot every snapshot_every versions, and whenever it is smaller than the delta (e.g. a re-ranked
+# playlist), so rebuilding any version applies at most snapshot_every - 1 deltas.
+# The latest order and the song numbers are kept in <playlist name>.latest.json, so archiving a new version does
+# not re-read the whole archive. It is rebuilt from the archive whenever it doesn't match it.
+#   python ordering_archive.py <local storage location> list <playlist name>
+#   python ordering_archive.py <local storage location> diff <playlist name> <version> <version>
+#   python ordering_archive.py <local storage location> rollback <playlist name> <version> <credential location>
+archive_dirname = 'ordering_archive'
+snapshot_every = 50
+
+
+def archive_path(storage_filepath, playlist_name):
+    return os.path.join(storage_filepath, archive_dirname, playlist_name + '.jsonl')
+
+
+def latest_path(storage_filepath, playlist_name):
+    return os.path.join(storage_filepath, archive_dirname, playlist_name + '.latest.json')
+
+
+def longest_ordered_run(positions):
+    # Indices of a longest strictly increasing subsequence of positions, in O(n log n).
+    tail_values = []
+    tail_indices = []
+    previous = [-1] * len(positions)
+    for index, position in enumerate(positions):
+        slot = bisect_left(tail_values, position)
+        if slot == len(tail_values):
+            tail_values.append(position)
+            tail_indices.append(index)
+        else:
+            tail_values[slot] = position
+            tail_indices[slot] = index
+        previous[index] = tail_indices[slot - 1] if slot else -1
+    run = []
+    index = tail_indices[-1] if tail_indices else -1
+    while index != -1:
+        run.append(index)
+        index = previous[index]
+    return run[::-1]
+
+
+def anchored_tracks(old_order, new_order):
+    # The songs of new_order that can stay where they are relative to each other: the longest run of songs that
+    # appear in the same order in old_order.
+    old_positions = {track_id: position for position, track_id in enumerate(old_order)}
+    kept = [track_id for track_id in new_order if track_id in old_positions]
+    return {kept[index] for index in longest_ordered_run([old_positions[track_id] for track_id in kept])}
+
+
+def ordering_delta(old_order, new_order):
+    new_ids = set(new_order)
+    anchors = anchored_tracks(old_order, new_order)
+    return {'removed': [track_id for track_id in old_order if track_id not in new_ids],
+            'placed': [[position, track_id] for position, track_id in enumerate(new_order)
+                       if track_id not in anchors]}
+
+
+def apply_delta(old_order, delta):
+    placed_ids = {track_id for _, track_id in delta['placed']}
+    removed_ids = set(delta['removed'])
+    order = [track_id for track_id in old_order if track_id not in removed_ids and track_id not in placed_ids]
+    for position, track_id in delta['placed']:
+        order.insert(position, track_id)
+    return order
+
+
+def decode_entry(entry, vocabulary):
+    # Adds the songs first seen in this version to the vocabulary, and returns the entry with song numbers turned
+    # back into track ids. (Track ids stored as text are left as they are.)
+    vocabulary.extend(entry.get('tracks', []))
+
+    def track(song):
+        return vocabulary[song] if isinstance(song, int) else song
+    entry = {key: value for key, value in entry.items() if key != 'tracks'}
+    if 'snapshot' in entry:
+        entry['snapshot'] = [track(song) for song in entry['snapshot']]
+    if 'delta' in entry:
+        entry['delta'] = {'removed': [track(song) for song in entry['delta']['removed']],
+                          'placed': [[position, track(song)] for position, song in entry['delta']['placed']]}
+    return entry
+
+
+def read_archive_vocabulary(storage_filepath, playlist_name):
+    # Returns the archived version entries of the playlist, oldest first, and the archive's song numbering.
+    entries = []
+    vocabulary = []
+    for entry in read_jsonl(archive_path(storage_filepath, playlist_name)):
+        entry = decode_entry(entry, vocabulary)
+        if 'snapshot' not in entry and not (entries and entry.get('base') == entries[-1]['version']):
+            print('Ordering archive version', entry.get('version'), 'has no base version, skipped.')
+            continue
+        entries.append(entry)
+    return entries, vocabulary
+
+
+def read_archive(storage_filepath, playlist_name):
+    return read_archive_vocabulary(storage_filepath, playlist_name)[0]
+
+
+def version_order(entries, position):
+    # Rebuilds the track order of entries[position] from the nearest snapshot at or before it.
+    start = position
+    while 'snapshot' not in entries[start]:
+        start -= 1
+    order = entries[start]['snapshot']
+    for entry in entries[start + 1:position + 1]:
+        order = apply_delta(order, entry['delta'])
+    return order
+
+
+def all_version_orders(entries):
+    # Yields (entry, track order) for every version, applying each delta once.
+    order = []
+    for entry in entries:
+        order = entry['snapshot'] if 'snapshot' in entry else apply_delta(order, entry['delta'])
+        yield entry, order
+
+
+def latest_state(storage_filepath, playlist_name):
+    # The latest version, its order, the song numbering and the number of versions since the last snapshot, from
+    # <playlist name>.latest.json if it was written for the archive as it is now, or else from the archive.
+    archive_file = archive_path(storage_filepath, playlist_name)
+    archive_size = os.path.getsize(archive_file) if os.path.exists(archive_file) else 0
+    state = read_json(latest_path(storage_filepath, playlist_name))
+    if state and state.get('archive_size') == archive_size:
+        return state
+
+    entries, vocabulary = read_archive_vocabulary(storage_filepath, playlist_name)
+    if not entries:
+        return {'version': 0, 'order': None, 'vocabulary': vocabulary, 'since_snapshot': 0}
+    since_snapshot = next(count for count, entry in enumerate(reversed(entries)) if 'snapshot' in entry)
+    return {'version': entries[-1]['version'], 'order': version_order(entries, len(entries) - 1),
+            'vocabulary': vocabulary, 'since_snapshot': since_snapshot}
+
+
+def record_ordering(storage_filepath, playlist_name, track_ids, note=None):
+    # Archives the order just written to the playlist, unless it is the same as the latest version.
+    os.makedirs(os.path.join(storage_filepath, archive_dirname), exist_ok=True)
+    state = latest_state(storage_filepath, playlist_name)
+    track_ids = list(track_ids)
+    latest_order = state['order']
+    if latest_order == track_ids:
+        return state['version']
+
+    entry = {'version': state['version'] + 1,
+             'created_at': datetime.now(pytz.UTC).strftime('%Y-%m-%dT%H:%M:%SZ')}
+    if note:
+        entry['note'] = note
+    vocabulary = state['vocabulary']
+    song_numbers = {track_id: song for song, track_id in enumerate(vocabulary)}
+    new_tracks = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in song_numbers]
+    if new_tracks:
+        entry['tracks'] = new_tracks
+        song_numbers.update((track_id, len(vocabulary) + offset) for offset, track_id in enumerate(new_tracks))
+        vocabulary.extend(new_tracks)
+
+    delta = ordering_delta(latest_order, track_ids) \
+        if latest_order is not None and len(set(track_ids)) == len(track_ids) else None
+    if delta is None or state['since_snapshot'] + 1 >= snapshot_every \
+            or len(delta['removed']) + 2 * len(delta['placed']) >= len(track_ids):
+        entry['snapshot'] = [song_numbers[track_id] for track_id in track_ids]
+        since_snapshot = 0
+    else:
+        entry['base'] = state['version']
+        entry['delta'] = {'removed': [song_numbers[track_id] for track_id in delta['removed']],
+                          'placed': [[position, song_numbers[track_id]] for position, track_id in delta['placed']]}
+        since_snapshot = state['since_snapshot'] + 1
+    append_jsonl(archive_path(storage_filepath, playlist_name), entry)
+    atomic_write_json(latest_path(storage_filepath, playlist_name),
+                      {'archive_size': os.path.getsize(archive_path(storage_filepath, playlist_name)),
+                       'version': entry['version'], 'order': track_ids, 'vocabulary': vocabulary,
+                       'since_snapshot': since_snapshot})
+    return entry['version']
+
+
+def get_version(entries, version):
+    for position, entry in enumerate(entries):
+        if entry['version'] == version:
+            return version_order(entries, position)
+    print('Version', version, 'not found. Available versions:', entries[0]['version'] if entries else None,
+          'to', entries[-1]['version'] if entries else None)
+    sys.exit(1)
+
+
+def diff_orderings(old_order, new_order):
+    # Prints what changed between two orders: songs added, removed, and moved.
+    delta = ordering_delta(old_order, new_order)
+    old_positions = {track_id: position for position, track_id in enumerate(old_order)}
+    added = [(position, track_id) for position, track_id in delta['placed'] if track_id not in old_positions]
+    moved = [(position, track_id) for position, track_id in delta['placed'] if track_id in old_positions]
+    print(len(added), 'added,', len(delta['removed']), 'removed,', len(moved), 'moved,',
+          len(new_order) - len(added) - len(moved), 'kept in order.')
+    for position, track_id in added:
+        print('  + #' + str(position + 1), track_id)
+    for track_id in delta['removed']:
+        print('  - #' + str(old_positions[track_id] + 1), track_id)
+    for position, track_id in moved:
+        print('  ~ #' + str(old_positions[track_id] + 1), '-> #' + str(position + 1), track_id)
+    return delta
+
+
+def replace_calls(target_order, batch_size=100):
+    # Calls for re-writing the playlist from scratch: one replace, then adds of up to 100 songs.
+    calls = [('playlist_replace_items', target_order[:batch_size])]
+    for start in range(batch_size, len(target_order), batch_size):
+        calls.append(('playlist_add_items', target_order[start:start + batch_size]))
+    return calls
+
+
+def edit_calls(current_order, target_order, batch_size=100):
+    # Calls that turn current_order into target_order in place: remove the songs that go, then walk the target
+    # order and put every song that is not anchored right after the song before it. Runs of new songs are added
+    # in one call; each moved song is one reorder call.
+    target_ids = set(target_order)
+    removed = [track_id for track_id in current_order if track_id not in target_ids]
+    calls = [('playlist_remove_all_occurrences_of_items', removed[start:start + batch_size])
+             for start in range(0, len(removed), batch_size)]
+    state = [track_id for track_id in current_order if track_id in target_ids]
+    anchors = anchored_tracks(state, target_order)
+
+    position = 0
+    while position < len(target_order):
+        track_id = target_order[position]
+        insert_before = state.index(target_order[position - 1]) + 1 if position else 0
+        if track_id in anchors:
+            position += 1
+        elif track_id not in state:
+            new_run = []
+            while position < len(target_order) and target_order[position] not in state \
+                    and target_order[position] not in anchors and len(new_run) < batch_size:
+                new_run.append(target_order[position])
+                position += 1
+            calls.append(('playlist_add_items', new_run, insert_before))
+            state[insert_before:insert_before] = new_run
+        else:
+            range_start = state.index(track_id)
+            calls.append(('playlist_reorder_items', range_start, insert_before))
+            state.pop(range_start)
+            state.insert(insert_before if insert_before < range_start else insert_before - 1, track_id)
+            position += 1
+    return calls, state
+
+
+def rollback(storage_filepath, playlist_name, version, credential_location):
+    # Puts the playlist back to an archived version, with whichever of an in-place edit or a full re-write
+    # needs fewer calls to Spotify. Holds the pipeline lock, so it cannot run alongside an update of the same
+    # storage location.
+    pipeline_lock = acquire_pipeline_lock(storage_filepath)
+    try:
+        rollback_playlist(storage_filepath, playlist_name, version, credential_location)
+    finally:
+        release_pipeline_lock(pipeline_lock)
+
+
+def rollback_playlist(storage_filepath, playlist_name, version, credential_location):
+    # Imported here, since spotify_functions imports this module to archive each playlist update.
+    import spotify_functions as sf
+    target_order = get_version(read_archive(storage_filepath, playlist_name), version)
+    sp = sf.spotify_login(credential_location)
+    sf.synchronize_playlist(sp, storage_filepath, playlist_name)
+    current_order = pd.read_csv(os.path.join(storage_filepath, playlist_name + '.csv'))['track_id'].dropna().tolist()
+    list_id = sf.get_playlist_id(storage_filepath, playlist_name)
+
+    calls, edited_order = edit_calls(current_order, target_order)
+    if len(set(current_order)) != len(current_order) or edited_order != target_order \
+            or len(calls) >= len(replace_calls(target_order)):
+        calls = replace_calls(target_order)
+    sf.print_break()
+    print('Rolling', playlist_name, 'back to version', version, 'with', len(calls), 'calls to Spotify.')
+    for call in calls:
+        if call[0] == 'playlist_reorder_items':
+            sp.playlist_reorder_items(list_id, range_start=call[1], insert_before=call[2])
+        elif call[0] == 'playlist_add_items' and len(call) == 3:
+            sp.playlist_add_items(list_id, call[1], position=call[2])
+        else:
+            getattr(sp, call[0])(list_id, call[1])
+    record_ordering(storage_filepath, playlist_name, target_order, note='rollback to version ' + str(version))
+    print(playlist_name, 'rolled back to version', version)
+
+
+if __name__ == '__main__':
+    storage_location, command, playlist = sys.argv[1], sys.argv[2], sys.argv[3]
+    if command == 'list':
+        for version_entry, order in all_version_orders(read_archive(storage_location, playlist)):
+            print('Version', version_entry['version'], version_entry['created_at'], '-', len(order), 'songs',
+                  '(snapshot)' if 'snapshot' in version_entry else '', version_entry.get('note', ''))
+    elif command == 'diff':
+        archive_versions = read_archive(storage_location, playlist)
+        diff_orderings(get_version(archive_versions, int(sys.argv[4])), get_version(archive_versions, int(sys.argv[5])))
+    elif command == 'rollback':
+        rollback(storage_location, playlist, int(sys.argv[4]), sys.argv[5])
+    else:
+        print('Unknown command', command, '- use list, diff or rollback.')
@@ -0,0 +1,181 @@
+import os
+import numpy as np
+import pandas as pd
+from file_storage import atomic_to_csv
+from run_journal import fingerprint, stage_unchanged, record_fingerprint
+
+# The play rollup keeps one row per (track_id, UTC day) with the number of plays that day and the latest play.
+# Windowed stats ("plays in the last N days", "last played") read the rollup instead of the full listening
+# history, so their cost depends on the number of days with plays rather than the lifetime number of plays.
+# Days and last-played values come from the 'played_at' column, which Spotify reports in UTC.
+# The size and modification time of listen_history.csv are recorded whenever the rollup is brought in line with it,
+# so a history changed any other way (an imported account download, a hand edit) is noticed and the rollup rebuilt.
+rollup_columns = ['track_id', 'day', 'plays', 'tracked_plays', 'last_played', 'tracked_last_played']
+
+
+def standardize_played_at(played_at):
+    # Same format as dt_standardize in spotify_functions: 2025-02-12T18:04:11.123Z
+    return format_played_at(pd.to_datetime(played_at, utc=True, format='ISO8601'))
+
+
+def format_played_at(played_dt):
+    return played_dt.dt.strftime('%Y-%m-%dT%H:%M:%S.%f').str[:-3] + 'Z'
+
+
+def rollup_rows(plays_df):
+    # Aggregates individual plays into rollup rows. Aggregation is done on datetimes, and only the
+    # aggregated rows are formatted back to strings.
+    if plays_df.empty:
+        return pd.DataFrame(columns=rollup_columns)
+    played_dt = pd.to_datetime(plays_df['played_at'], utc=True, format='ISO8601')
+    tracked = (plays_df['played_on_tracked_list'] == True)
+    plays = pd.DataFrame({'track_id': plays_df['track_id'].values,
+                          'day': played_dt.dt.floor('D').values,
+                          'played_at': played_dt.values,
+                          'tracked': tracked.values,
+                          'tracked_played_at': played_dt.where(tracked).values})
+    rollup_df = plays.groupby(['track_id', 'day'], as_index=False).agg(
+        plays=('played_at', 'size'),
+        tracked_plays=('tracked', 'sum'),
+        last_played=('played_at', 'max'),
+        tracked_last_played=('tracked_played_at', 'max'))
+    rollup_df['day'] = rollup_df['day'].dt.strftime('%Y-%m-%d')
+    rollup_df['last_played'] = format_played_at(rollup_df['last_played'])
+    rollup_df['tracked_last_played'] = format_played_at(rollup_df['tracked_last_played'])
+    return rollup_df[rollup_columns]
+
+
+def rollup_filename(storage_filepath):
+    return os.path.join(storage_filepath, 'play_rollup.csv')
+
+
+def history_signature(storage_filepath):
+    # Size and modification time of the listening history, or None if there is none.
+    try:
+        stat = os.stat(os.path.join(storage_filepath, 'listen_history.csv'))
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def record_rollup_source(storage_filepath):
+    # Records that the rollup matches the listening history as it is now.
+    record_fingerprint(storage_filepath, 'play_rollup', fingerprint(history_signature(storage_filepath)))
+
+
+def rollup_is_current(storage_filepath):
+    return os.path.exists(rollup_filename(storage_filepath)) \
+        and stage_unchanged(storage_filepath, 'play_rollup', fingerprint(history_signature(storage_filepath)))
+
+
+def build_play_rollup(storage_filepath):
+    # Rebuilds the rollup from the complete listening history. Needed the first time, and whenever the history
+    # was changed outside this script.
+    history_df = pd.read_csv(os.path.join(storage_filepath, 'listen_history.csv'))
+    history_df = history_df.dropna(subset=['track_id', 'played_at'])
+    rollup_df = rollup_rows(history_df)
+    atomic_to_csv(rollup_df, rollup_filename(storage_filepath))
+    record_rollup_source(storage_filepath)
+    print('Play rollup built from', len(history_df), 'plays:', len(rollup_df), 'track-days.')
+    return rollup_df
+
+
+def read_play_rollup(storage_filepath):
+    # Returns the rollup, rebuilding it first if it is missing or the history changed since it was last updated.
+    if not rollup_is_current(storage_filepath):
+        if os.path.exists(rollup_filename(storage_filepath)):
+            print('listen_history.csv changed since the play rollup was last updated, rebuilding it.')
+        return build_play_rollup(storage_filepath)
+    return pd.read_csv(rollup_filename(storage_filepath))
+
+
+def refresh_play_rollup(storage_filepath):
+    # Call before rewriting the listening history, so the incremental updates below start from a current rollup.
+    if not rollup_is_current(storage_filepath):
+        read_play_rollup(storage_filepath)
+
+
+def update_play_rollup(storage_filepath, history_df, changed_plays_df):
+    # Brings the rollup in line with an updated listening history. changed_plays_df holds the plays that were
+    # added to or dropped from the history; only the (track_id, day) rows they touch are recalculated.
+    if not os.path.exists(rollup_filename(storage_filepath)):
+        return build_play_rollup(storage_filepath)
+    rollup_df = pd.read_csv(rollup_filename(storage_filepath))
+
+    changed_plays_df = changed_plays_df.dropna(subset=['track_id', 'played_at'])
+    if changed_plays_df.empty:
+        record_rollup_source(storage_filepath)
+        return rollup_df
+    touched_keys = pd.DataFrame({'track_id': changed_plays_df['track_id'].values,
+                                 'day': standardize_played_at(changed_plays_df['played_at']).str[:10].values})
+    touched_keys = touched_keys.drop_duplicates()
+
+    # Recalculate the touched rows from the matching plays in the updated history.
+    candidate_plays = history_df[history_df['track_id'].isin(touched_keys['track_id'])]
+    candidate_plays = candidate_plays.dropna(subset=['track_id', 'played_at'])
+    recalculated = rollup_rows(candidate_plays).merge(touched_keys, on=['track_id', 'day'])
+
+    untouched = rollup_df.merge(touched_keys, on=['track_id', 'day'], how='left', indicator=True)
+    untouched = untouched[untouched['_merge'] == 'left_only'][rollup_columns]
+    rollup_df = pd.concat([untouched, recalculated], ignore_index=True)
+    rollup_df = rollup_df.sort_values(by=['track_id', 'day']).reset_index(drop=True)
+    atomic_to_csv(rollup_df, rollup_filename(storage_filepath))
+    record_rollup_source(storage_filepath)
+    print('Play rollup updated for', len(touched_keys), 'track-days.')
+    return rollup_df
+
+
+def replace_rollup_track_id(storage_filepath, old_value, new_value):
+    # Mirrors a track_id substitution in the listening history, combining days the two ids have in common.
+    if not os.path.exists(rollup_filename(storage_filepath)):
+        return
+    rollup_df = pd.read_csv(rollup_filename(storage_filepath))
+    rollup_df['track_id'] = rollup_df['track_id'].replace(old_value, new_value)
+    rollup_df = rollup_df.groupby(['track_id', 'day'], as_index=False).agg(
+        plays=('plays', 'sum'),
+        tracked_plays=('tracked_plays', 'sum'),
+        last_played=('last_played', 'max'),
+        tracked_last_played=('tracked_last_played', 'max'))
+    atomic_to_csv(rollup_df[rollup_columns], rollup_filename(storage_filepath))
+    record_rollup_source(storage_filepath)
+
+
+def rollup_last_played(rollup_df, tracked_only):
+    # Returns track_id, last_played for every track with at least one (tracked) play.
+    last_col = 'tracked_last_played' if tracked_only else 'last_played'
+    last_played = rollup_df.dropna(subset=[last_col]).groupby('track_id')[last_col].max().reset_index()
+    return last_played.rename(columns={last_col: 'last_played'})
+
+
+def rollup_window_counts(rollup_df, window_days, today, tracked_only):
+    # Returns track_id and the number of plays on or after the UTC day (today - N days) for each N in
+    # window_days, as columns named by N. Uses per-track prefix sums over the day-sorted rollup, so each
+    # window is a binary search per track instead of a scan.
+    count_col = 'tracked_plays' if tracked_only else 'plays'
+    played = rollup_df[rollup_df[count_col] > 0].sort_values(by=['track_id', 'day'])
+    counts_df = pd.DataFrame({'track_id': pd.unique(played['track_id'])})
+    if played.empty:
+        for days in window_days:
+            counts_df[days] = pd.Series(dtype='int64')
+        return counts_df
+
+    # Encode (track, day) as a single sortable integer key.
+    track_codes = pd.factorize(played['track_id'], sort=False)[0].astype(np.int64)
+    day_numbers = (pd.to_datetime(played['day']) - pd.Timestamp('1970-01-01')).dt.days.to_numpy(np.int64)
+    day_span = day_numbers.max() + 2
+    keys = track_codes * day_span + day_numbers
+    cumulative = played[count_col].to_numpy(np.int64).cumsum()
+
+    codes = np.arange(len(counts_df), dtype=np.int64)
+    track_starts = np.searchsorted(keys, codes * day_span, side='left')
+    track_ends = np.searchsorted(keys, (codes + 1) * day_span, side='left')
+    before_track = np.where(track_starts > 0, cumulative[track_starts - 1], 0)
+    track_totals = cumulative[track_ends - 1] - before_track
+
+    for days in window_days:
+        cutoff_day = (pd.Timestamp(today.date()) - pd.Timestamp('1970-01-01')).days - days
+        cutoff_day = min(max(cutoff_day, -1), day_span - 1)
+        split = np.searchsorted(keys, codes * day_span + cutoff_day, side='left')
+        before_cutoff = np.where(split > track_starts, cumulative[split - 1], before_track) - before_track
+        counts_df[days] = track_totals - before_cutoff
+    return counts_df
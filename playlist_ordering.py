@@ -0,0 +1,196 @@
+import heapq
+from collections import deque
+import numpy as np
+import pandas as pd
+
+# Running cadence sits around 150-190 steps per minute, so half-time songs (e.g. 85 bpm) are treated as
+# double their tempo when deciding where they belong on a run.
+half_time_cutoff_bpm = 110
+
+
+def window_stars(star_rating):
+    # Unrated (0 star) songs are counted over the 5 star window, same as star_plays() in spotify_functions.
+    return np.where(star_rating == 0, 5, star_rating)
+
+
+def ranking_order(star_plays, random_num):
+    # The playlist order: songs with the fewest plays inside their star window first, ties broken by the
+    # random number. Returns positions into the input arrays. Shared by update_rankings and the simulator.
+    return np.lexsort((random_num, star_plays))
+
+
+def cadence_bpm(tempo):
+    # Folds a song tempo (Series) into the running cadence range.
+    return tempo.where(tempo >= half_time_cutoff_bpm, tempo * 2)
+
+
+def tempo_curve_order(ranked_df, num_songs, warm_up_share=0.2, finish_share=0.2):
+    # Re-orders the top num_songs of an already ranked dataframe into a run-shaped tempo curve:
+    #   warm-up: the lowest-cadence songs, slowest first
+    #   steady:  the middle of the selection, left in ranked order
+    #   finish:  the highest-energy songs, building to the most energetic
+    # Which songs are selected does not change, only their order. Songs without tempo/energy values stay
+    # in the steady section. Rows beyond num_songs are returned untouched.
+    top_df = ranked_df.head(num_songs)
+    rest_df = ranked_df.iloc[num_songs:]
+    known_df = top_df[top_df['tempo'].notna() & top_df['energy'].notna()].copy()
+    if known_df.empty:
+        return ranked_df
+
+    warm_up_count = int(round(len(top_df) * warm_up_share))
+    finish_count = int(round(len(top_df) * finish_share))
+
+    known_df['cadence_bpm'] = cadence_bpm(known_df['tempo'])
+    warm_up_df = known_df.nsmallest(warm_up_count, 'cadence_bpm').sort_values('cadence_bpm')
+    finish_df = known_df.drop(warm_up_df.index).nlargest(finish_count, 'energy').sort_values('energy')
+    steady_df = top_df.drop(warm_up_df.index).drop(finish_df.index)
+
+    warm_up_df = warm_up_df.drop(columns='cadence_bpm')
+    finish_df = finish_df.drop(columns='cadence_bpm')
+    return pd.concat([warm_up_df, steady_df, finish_df, rest_df])
+
+
+def duration_budget_selection(durations_ms, target_ms, swap_songs=3, fill_window=25):
+    # Picks songs, in ranked order, to fill a playlist to target_ms. Returns their positions in durations_ms.
+    #   1. Greedy: walk the ranked order, taking songs until the next one no longer fits. This is never more
+    #      than one song short of the target.
+    #   2. Fix-up: the last few greedy picks are released, and a small 0/1 knapsack (1-second resolution) chooses
+    #      which of them plus the next fill_window ranked songs get closest to the target. Among equally close
+    #      choices the higher-ranked songs win. The greedy choice is one of the options, so this is never worse.
+    durations_s = np.round(np.asarray(durations_ms, dtype=float) / 1000).astype(np.int64)
+    target_s = int(round(target_ms / 1000))
+
+    running_total = np.cumsum(durations_s)
+    greedy_count = int(np.searchsorted(running_total, target_s, side='right'))
+    fixed_count = max(greedy_count - swap_songs, 0)
+    fixed_total = int(running_total[fixed_count - 1]) if fixed_count else 0
+    pool = np.arange(fixed_count, min(greedy_count + fill_window, len(durations_s)))
+    if len(pool) == 0:
+        return list(range(greedy_count))
+
+    # best_cost[s]: lowest sum of ranks of pool songs totalling exactly s seconds (inf if impossible).
+    # Totals up to one song past the target are allowed.
+    capacity = target_s - fixed_total + int(durations_s[pool].max())
+    best_cost = np.full(capacity + 1, np.inf)
+    best_cost[0] = 0
+    taken = np.zeros((len(pool), capacity + 1), dtype=bool)
+    for item, position in enumerate(pool):
+        duration = int(durations_s[position])
+        if duration <= 0 or duration > capacity:
+            continue
+        with_song = np.full(capacity + 1, np.inf)
+        with_song[duration:] = best_cost[:-duration] + (position - fixed_count)
+        taken[item] = with_song < best_cost
+        best_cost = np.minimum(best_cost, with_song)
+
+    # Closest total to the target, then lowest rank cost.
+    totals = np.arange(capacity + 1)
+    reachable = np.isfinite(best_cost)
+    distance = np.where(reachable, np.abs(fixed_total + totals - target_s), np.iinfo(np.int64).max)
+    best_total = int(np.lexsort((best_cost, distance))[0])
+
+    chosen = []
+    remaining = best_total
+    for item in range(len(pool) - 1, -1, -1):
+        if taken[item, remaining]:
+            chosen.append(int(pool[item]))
+            remaining -= int(durations_s[pool[item]])
+    return list(range(fixed_count)) + sorted(chosen)
+
+
+def artist_spacing_order(artists, albums=None, artist_gap=3, album_gap=0):
+    # Re-orders a ranked list so at least artist_gap other songs sit between two songs by the same artist (and
+    # album_gap between two songs from the same album), staying as close to the ranked order as possible.
+    # Returns (positions in the new order, number of times a gap had to be relaxed).
+    # Greedy: each artist's songs wait in ranked order, and at every slot the best-ranked song whose artist and
+    # album are both clear of their gaps is placed. Artists still inside their gap wait in a cooldown heap keyed
+    # by the slot they become clear, so each song costs O(log n) and the whole list O(n log n). Songs without an
+    # artist are never held back. An artist with so many songs left that they only just fit, spaced out, into the
+    # remaining slots goes first, so it is not left to bunch up at the end. If every remaining artist is cooling
+    # down, the one that clears soonest is placed anyway, and counted as a relaxed constraint.
+    artist_songs = {}
+    for position, artist in enumerate(artists):
+        key = artist if isinstance(artist, str) else ('no artist', position)
+        artist_songs.setdefault(key, deque()).append(position)
+
+    # ready: (rank of the artist's next song, artist). cooldown: (slot it clears, rank of next song, artist).
+    # most_songs: (-songs left, artist), with outdated entries skipped when read.
+    ready = [(songs[0], key) for key, songs in artist_songs.items()]
+    heapq.heapify(ready)
+    ready_keys = set(artist_songs)
+    most_songs = [(-len(songs), key) for key, songs in artist_songs.items() if isinstance(key, str)]
+    heapq.heapify(most_songs)
+    cooldown = []
+    album_clear_slot = {}
+    order = []
+    relaxed = 0
+
+    def album_clear(rank):
+        # The slot from which the album of the song at rank is clear of its gap.
+        album = albums[rank] if albums is not None and album_gap else None
+        return album_clear_slot.get(album, 0) if isinstance(album, str) else 0
+
+    for slot in range(len(artists)):
+        while cooldown and cooldown[0][0] <= slot:
+            _, rank, key = heapq.heappop(cooldown)
+            heapq.heappush(ready, (rank, key))
+            ready_keys.add(key)
+
+        chosen = None
+        while most_songs and -most_songs[0][0] != len(artist_songs[most_songs[0][1]]):
+            heapq.heappop(most_songs)
+        if artist_gap and most_songs:
+            songs_left, key = -most_songs[0][0], most_songs[0][1]
+            if key in ready_keys and (songs_left - 1) * (artist_gap + 1) + 1 >= len(artists) - slot \
+                    and album_clear(artist_songs[key][0]) <= slot:
+                chosen = (artist_songs[key][0], key)
+
+        while chosen is None and ready:
+            rank, key = heapq.heappop(ready)
+            if key not in ready_keys or rank != artist_songs[key][0]:
+                continue
+            album_slot = album_clear(rank)
+            if album_slot <= slot:
+                chosen = (rank, key)
+                break
+            # Album still inside its gap: wait until it clears.
+            heapq.heappush(cooldown, (album_slot, rank, key))
+            ready_keys.discard(key)
+
+        if chosen is None:
+            _, rank, key = heapq.heappop(cooldown)
+            chosen = (rank, key)
+            relaxed += 1
+
+        rank, key = chosen
+        ready_keys.discard(key)
+        order.append(rank)
+        songs = artist_songs[key]
+        songs.popleft()
+        if songs:
+            heapq.heappush(cooldown, (slot + artist_gap + 1, songs[0], key))
+            if isinstance(key, str):
+                heapq.heappush(most_songs, (-len(songs), key))
+        album = albums[rank] if albums is not None and album_gap else None
+        if isinstance(album, str):
+            album_clear_slot[album] = slot + album_gap + 1
+    return order, relaxed
+
+
+def spacing_violations(artists, albums=None, artist_gap=3, album_gap=0):
+    # Number of songs placed within artist_gap of an earlier song by the same artist, or within album_gap of an
+    # earlier song from the same album. Songs without an artist (or album) never count.
+    last_artist_slot = {}
+    last_album_slot = {}
+    violations = 0
+    for slot, artist in enumerate(artists):
+        album = albums[slot] if albums is not None and album_gap else None
+        artist_close = isinstance(artist, str) and artist in last_artist_slot \
+            and slot - last_artist_slot[artist] <= artist_gap
+        album_close = isinstance(album, str) and album in last_album_slot and slot - last_album_slot[album] <= album_gap
+        violations += bool(artist_close or album_close)
+        if isinstance(artist, str):
+            last_artist_slot[artist] = slot
+        if isinstance(album, str):
+            last_album_slot[album] = slot
+    return violations
@@ -0,0 +1,74 @@
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytz
+from file_storage import atomic_to_csv
+
+# playlist_removals.csv is a ledger with one row per song ever removed from the tracked playlist, keyed by
+# track_id. It keeps the song's last rating, when it was removed and, if it came back, when it was re-added.
+# A song that is re-added to the tracked playlist gets its old star rating back instead of starting at 0.
+removals_filename = 'playlist_removals.csv'
+ledger_columns = ['track_id', 'track_name', 'artist_name', 'duration_ms', 'star_rating', 'last_played',
+                  'removed_at', 'readded_at']
+
+
+def ledger_timestamp():
+    return datetime.now(pytz.UTC).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def empty_ledger():
+    return pd.DataFrame(columns=ledger_columns).set_index('track_id')
+
+
+def read_removals_ledger(storage_filepath):
+    # Returns the ledger indexed by track_id. A removals file in the older append-only format (one row per
+    # removal, repeated across runs) is converted once, keeping the latest row for each song.
+    removals_file = os.path.join(storage_filepath, removals_filename)
+    if not os.path.exists(removals_file):
+        return empty_ledger()
+    removals_df = pd.read_csv(removals_file)
+    if 'removed_at' in removals_df.columns:
+        return removals_df.set_index('track_id')
+
+    print('Converting', removals_filename, 'to a ledger with one row per song.')
+    if 'stars' in removals_df.columns:
+        stars = removals_df['stars']
+        removals_df['star_rating'] = removals_df['star_rating'].fillna(stars) if 'star_rating' in removals_df.columns else stars
+    removals_df = removals_df.dropna(subset=['track_id']).drop_duplicates('track_id', keep='last')
+    ledger_df = removals_df.reindex(columns=ledger_columns).set_index('track_id')
+    write_removals_ledger(storage_filepath, ledger_df)
+    print(len(ledger_df), 'songs kept in the removals ledger.')
+    return ledger_df
+
+
+def write_removals_ledger(storage_filepath, ledger_df):
+    atomic_to_csv(ledger_df.reset_index()[ledger_columns], os.path.join(storage_filepath, removals_filename))
+
+
+def record_removals(ledger_df, removed_df):
+    # Adds songs removed from the tracked playlist. Songs already recorded as removed are left as they are, so
+    # recording the same removal twice changes nothing. Returns (ledger, number of songs newly recorded).
+    still_removed = ledger_df.index[ledger_df['readded_at'].isna()]
+    new_removals = removed_df[removed_df['track_id'].notna() & ~removed_df['track_id'].isin(still_removed)]
+    new_removals = new_removals.drop_duplicates('track_id', keep='last')
+    if new_removals.empty:
+        return ledger_df, 0
+
+    new_rows = new_removals.reindex(columns=ledger_columns).set_index('track_id')
+    new_rows['removed_at'] = ledger_timestamp()
+    new_rows['readded_at'] = np.nan
+    ledger_df = pd.concat([ledger_df.drop(new_rows.index, errors='ignore'), new_rows])
+    return ledger_df, len(new_rows)
+
+
+def restore_readded(ledger_df, added_track_ids):
+    # For songs added to the tracked playlist that were removed earlier, marks them re-added and returns their
+    # previous star ratings as {track_id: star_rating}. Songs being added are not in rankings.csv, so their rating
+    # is restored even if an earlier run that crashed before writing rankings.csv already marked them re-added.
+    removed_ratings = ledger_df['star_rating'].to_dict()
+    readded = [track_id for track_id in added_track_ids if track_id in removed_ratings]
+    if readded:
+        ledger_df['readded_at'] = ledger_df['readded_at'].astype(object)
+        ledger_df.loc[readded, 'readded_at'] = ledger_timestamp()
+    return {track_id: removed_ratings[track_id] for track_id in readded if pd.notna(removed_ratings[track_id])}
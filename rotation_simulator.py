@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from playlist_ordering import window_stars, ranking_order
+from spotify_functions import star_intervals
+
+# Replays months of simulated runs through the same ranking rule update_rankings uses, to see how a star-interval
+# policy actually plays out: how often each star level is heard, and how soon songs come back around.
+# Each simulated run plays the top songs_per_run of the dynamic playlist, then the playlist is re-ranked.
+# Everything per run is a NumPy operation over the whole library, so a year of runs takes milliseconds.
+
+
+def synthetic_library(num_tracks=1000, star_shares=(0.1, 0.15, 0.3, 0.25, 0.2), seed=0):
+    # Returns an array of star ratings (1-5) in the given proportions of 1, 2, 3, 4, 5 stars.
+    rng = np.random.default_rng(seed)
+    return rng.choice(np.arange(1, 6), size=num_tracks, p=np.array(star_shares) / sum(star_shares))
+
+
+def library_from_rankings(storage_filepath):
+    # Uses the star ratings from the local rankings file (unrated songs count as 0 stars).
+    rankings_df = pd.read_csv(os.path.join(storage_filepath, 'rankings.csv'))
+    return rankings_df['star_rating'].fillna(0).astype(int).to_numpy()
+
+
+def simulate_rotation(stars, intervals, num_days=365, run_every_days=2, songs_per_run=50, burn_in_days=None,
+                      seed=0):
+    # Simulates one policy. Returns a per-star-level summary dataframe of plays per 30 days and repeat gaps
+    # (days between consecutive plays of the same song), measured after a burn-in period.
+    rng = np.random.default_rng(seed)
+    stars = np.asarray(stars)
+    num_tracks = len(stars)
+    if burn_in_days is None:
+        burn_in_days = max(intervals.values())
+
+    # Days of play history each song's star_plays count covers.
+    window_lookup = np.zeros(6, dtype=np.int64)
+    for star_value, days_value in intervals.items():
+        window_lookup[star_value] = days_value
+    windows = window_lookup[window_stars(stars)]
+
+    # plays_before_day[d] = total plays of each song before day d. Plays in the last w days = total - that.
+    plays_before_day = np.zeros((num_days + 1, num_tracks), dtype=np.int32)
+    total_plays = np.zeros(num_tracks, dtype=np.int32)
+    track_index = np.arange(num_tracks)
+    run_days = np.arange(0, num_days, run_every_days)
+    played_tracks = np.empty((len(run_days), min(songs_per_run, num_tracks)), dtype=np.int64)
+
+    last_filled_day = 0
+    for run_number, day in enumerate(run_days):
+        plays_before_day[last_filled_day:day + 1] = total_plays
+        last_filled_day = day + 1
+
+        star_plays = total_plays - plays_before_day[np.maximum(day - windows, 0), track_index]
+        random_num = rng.integers(1, num_tracks * 2, size=num_tracks)
+        top_tracks = ranking_order(star_plays, random_num)[:songs_per_run]
+        played_tracks[run_number] = top_tracks
+        total_plays[top_tracks] += 1
+
+    # Flatten to one (track, day) row per play, and keep plays after the burn-in period.
+    play_tracks = played_tracks.ravel()
+    play_days = np.repeat(run_days, played_tracks.shape[1])
+    keep = play_days >= burn_in_days
+    play_tracks = play_tracks[keep]
+    play_days = play_days[keep]
+    measured_days = max(num_days - burn_in_days, 1)
+
+    # Repeat gaps: sort plays by song then day, and difference consecutive plays of the same song.
+    order = np.lexsort((play_days, play_tracks))
+    sorted_tracks = play_tracks[order]
+    sorted_days = play_days[order]
+    same_track = sorted_tracks[1:] == sorted_tracks[:-1]
+    gaps = (sorted_days[1:] - sorted_days[:-1])[same_track]
+    gap_stars = stars[sorted_tracks[1:][same_track]]
+
+    plays_per_track = np.bincount(play_tracks, minlength=num_tracks)
+    summary_rows = []
+    for star_value in sorted(np.unique(stars), reverse=True):
+        star_tracks = stars == star_value
+        star_gaps = gaps[gap_stars == star_value]
+        track_plays = plays_per_track[star_tracks] * 30 / measured_days
+        summary_rows.append({
+            'stars': int(star_value),
+            'window_days': int(window_lookup[window_stars(np.array([star_value]))[0]]),
+            'songs': int(star_tracks.sum()),
+            'plays_per_30_days': round(float(track_plays.mean()), 2),
+            'never_played_pct': round(float((plays_per_track[star_tracks] == 0).mean() * 100), 1),
+            'min_gap_days': int(star_gaps.min()) if len(star_gaps) else np.nan,
+            'p10_gap_days': float(np.percentile(star_gaps, 10)) if len(star_gaps) else np.nan,
+            'median_gap_days': float(np.median(star_gaps)) if len(star_gaps) else np.nan,
+            'p90_gap_days': float(np.percentile(star_gaps, 90)) if len(star_gaps) else np.nan,
+        })
+    return pd.DataFrame(summary_rows)
+
+
+def simulate_policy(args):
+    # Process-pool entry point: args is (policy name, intervals, stars, simulation keyword arguments).
+    policy_name, intervals, stars, simulation_kwargs = args
+    summary_df = simulate_rotation(stars, intervals, **simulation_kwargs)
+    summary_df.insert(0, 'policy', policy_name)
+    return summary_df
+
+
+def sweep_policies(policies, stars, processes=None, **simulation_kwargs):
+    # Simulates each named policy ({name: intervals}) in its own process and returns one combined summary.
+    jobs = [(policy_name, intervals, stars, simulation_kwargs) for policy_name, intervals in policies.items()]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(simulate_policy, jobs))
+    return pd.concat(results, ignore_index=True)
+
+
+def candidate_policies(base_intervals):
+    # The current policy, plus tighter / looser variants of it for comparison.
+    return {
+        'current': dict(base_intervals),
+        'tighter_x0.5': {star: max(1, days // 2) for star, days in base_intervals.items()},
+        'looser_x1.5': {star: int(days * 1.5) for star, days in base_intervals.items()},
+        'flat_5_star': {star: (days if star == 5 else base_intervals[4]) for star, days in base_intervals.items()},
+    }
+
+
+if __name__ == '__main__':
+    # Usage: python rotation_simulator.py [local_file_storage_location]
+    # Uses the star ratings from rankings.csv when a storage location is given, otherwise a synthetic library.
+    if len(sys.argv) > 1:
+        library_stars = library_from_rankings(sys.argv[1])
+    else:
+        library_stars = synthetic_library()
+
+    start_time = time.perf_counter()
+    simulate_rotation(library_stars, star_intervals)
+    print('One year of runs over', len(library_stars), 'songs simulated in',
+          round(time.perf_counter() - start_time, 3), 'seconds.')
+
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', 20)
+    print(sweep_policies(candidate_policies(star_intervals), library_stars).to_string(index=False))
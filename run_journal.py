@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+import shutil
+from datetime import datetime
+from file_storage import atomic_write_json, read_json
+import stage_profiler
+import generations
+
+# The run journal records which pipeline stages have completed. If a run dies part-way through
+# (API error, failed login, Ctrl-C at a prompt), the next run picks up at the first unfinished stage,
+# and any API batches already fetched for that stage are re-used from the run cache.
+journal_filename = 'run_journal.json'
+run_cache_dirname = 'run_cache'
+
+
+def journal_path(storage_filepath):
+    return os.path.join(storage_filepath, journal_filename)
+
+
+def run_cache_path(storage_filepath):
+    return os.path.join(storage_filepath, run_cache_dirname)
+
+
+def start_run(storage_filepath):
+    # Opens a new run journal, or resumes the journal of a previous run that did not finish.
+    journal = read_json(journal_path(storage_filepath))
+    if journal is None:
+        # Any leftover batches belong to a run that already finished, so they must not be re-used.
+        shutil.rmtree(run_cache_path(storage_filepath), ignore_errors=True)
+        journal = {'started_at': datetime.now().isoformat(timespec='seconds'), 'completed_stages': {}}
+        atomic_write_json(journal_path(storage_filepath), journal)
+    else:
+        print('Resuming unfinished run started at', journal['started_at'])
+        for stage_name in journal['completed_stages']:
+            print('  Stage already complete:', stage_name)
+    # Readers get a first generation even before any stage completes.
+    generations.publish_generation(storage_filepath, 'start_run')
+    return journal
+
+
+def run_stage(storage_filepath, stage_name, func, *args, **kwargs):
+    # Executes a single pipeline stage and records its completion (and return value) in the journal.
+    # A stage that completed in an unfinished earlier run is skipped, and its recorded result is returned.
+    journal = read_json(journal_path(storage_filepath))
+    if journal is not None and stage_name in journal['completed_stages']:
+        print('Skipping', stage_name, '-- completed in the resumed run.')
+        return journal['completed_stages'][stage_name]['result']
+
+    if stage_profiler.profiling_enabled:
+        result = stage_profiler.profile_stage(storage_filepath, stage_name, func, *args, **kwargs)
+    else:
+        result = func(*args, **kwargs)
+
+    if journal is not None:
+        journal['completed_stages'][stage_name] = {'completed_at': datetime.now().isoformat(timespec='seconds'),
+                                                   'result': result}
+        atomic_write_json(journal_path(storage_filepath), journal)
+
+    # Make the files this stage wrote visible to readers as a new generation.
+    generations.publish_generation(storage_filepath, stage_name)
+    return result
+
+
+def finish_run(storage_filepath):
+    # Removes the journal and the cached API batches once every stage has completed.
+    if os.path.exists(journal_path(storage_filepath)):
+        os.remove(journal_path(storage_filepath))
+    shutil.rmtree(run_cache_path(storage_filepath), ignore_errors=True)
+
+
+def cached_batch(storage_filepath, batch_name, fetch):
+    # Returns an API batch saved earlier in the current (resumed) run, or calls fetch() and saves the result.
+    # Outside of a journaled run, nothing is cached and fetch() is always called.
+    if not os.path.exists(journal_path(storage_filepath)):
+        return fetch()
+
+    batch_file = os.path.join(run_cache_path(storage_filepath), batch_name + '.json')
+    results = read_json(batch_file)
+    if results is not None:
+        print(batch_name, 're-used from the run cache.')
+        return results
+
+    results = fetch()
+    os.makedirs(run_cache_path(storage_filepath), exist_ok=True)
+    atomic_write_json(batch_file, results)
+    return results
+
+
+# Stage fingerprints persist across runs. A stage records a hash of its inputs when it completes, and can be
+# skipped on a later run if the hash is unchanged, re-using the output it wrote last time.
+fingerprint_filename = 'stage_fingerprints.json'
+
+
+def fingerprint(*parts):
+    # Hashes any json-serializable values (file hashes, parameters, track id lists) into a single fingerprint.
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def stage_unchanged(storage_filepath, stage_name, stage_fingerprint):
+    fingerprints = read_json(os.path.join(storage_filepath, fingerprint_filename), {})
+    return fingerprints.get(stage_name) == stage_fingerprint
+
+
+def record_fingerprint(storage_filepath, stage_name, stage_fingerprint):
+    fingerprint_file = os.path.join(storage_filepath, fingerprint_filename)
+    fingerprints = read_json(fingerprint_file, {})
+    fingerprints[stage_name] = stage_fingerprint
+    atomic_write_json(fingerprint_file, fingerprints)
@@ -0,0 +1,131 @@
+import os
+import sys
+import math
+import time
+import numpy as np
+import pandas as pd
+from file_storage import atomic_to_csv
+from generations import current_generation_path, generation_file
+
+# Checks whether plays of the tracked playlist look like a fair shuffle. For each group of plays (all plays,
+# plays from / not from the tracked list, inferred / explicit plays), every tracked song should be played at
+# roughly the same rate. Reports a chi-square goodness-of-fit test against that uniform rate, the dispersion
+# index of per-song play counts, and the gap (in plays) between repeats of the same song.
+# Run with: python shuffle_audit.py <local_file_storage_location>
+
+
+def chi_square_p_value(chi_square, degrees_of_freedom):
+    # Upper-tail p-value using the Wilson-Hilferty normal approximation (accurate for the large degrees of
+    # freedom a playlist produces, and avoids needing scipy).
+    if degrees_of_freedom <= 0:
+        return np.nan
+    scale = 2 / (9 * degrees_of_freedom)
+    z = ((chi_square / degrees_of_freedom) ** (1 / 3) - (1 - scale)) / math.sqrt(scale)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def audit_group(group_name, track_codes, num_tracks):
+    # track_codes: the tracked-playlist index of each play, in play order.
+    num_plays = len(track_codes)
+    result = {'group': group_name, 'plays': num_plays, 'tracked_songs': num_tracks}
+    if num_plays == 0 or num_tracks < 2:
+        return result
+
+    # Play frequency vs the uniform rate.
+    counts = np.bincount(track_codes, minlength=num_tracks)
+    expected = num_plays / num_tracks
+    chi_square = float(((counts - expected) ** 2).sum() / expected)
+    result['expected_plays_per_song'] = round(expected, 2)
+    result['min_song_plays'] = int(counts.min())
+    result['max_song_plays'] = int(counts.max())
+    result['never_played_songs'] = int((counts == 0).sum())
+    result['chi_square'] = round(chi_square, 1)
+    result['chi_square_p_value'] = chi_square_p_value(chi_square, num_tracks - 1)
+    # Near 1 for a fair shuffle; well above 1 means some songs are favored.
+    result['dispersion_index'] = round(float(counts.var() / counts.mean()), 3)
+
+    # Repeat gaps: plays between consecutive plays of the same song. For a fair shuffle the gap is geometric
+    # with a mean of num_tracks, so 'short repeats' (within a tenth of the playlist) should be rare.
+    play_positions = np.arange(num_plays)
+    order = np.lexsort((play_positions, track_codes))
+    sorted_codes = track_codes[order]
+    sorted_positions = play_positions[order]
+    same_song = sorted_codes[1:] == sorted_codes[:-1]
+    gaps = (sorted_positions[1:] - sorted_positions[:-1])[same_song]
+    if len(gaps):
+        short_gap = max(1, num_tracks // 10)
+        result['median_repeat_gap'] = float(np.median(gaps))
+        result['p10_repeat_gap'] = float(np.percentile(gaps, 10))
+        result['expected_median_gap'] = round(math.log(2) / -math.log(1 - 1 / num_tracks), 1)
+        result['short_repeat_pct'] = round(float((gaps <= short_gap).mean() * 100), 2)
+        result['expected_short_repeat_pct'] = round((1 - (1 - 1 / num_tracks) ** short_gap) * 100, 2)
+    return result
+
+
+def position_bias(history_df, dynamic_df, session_ms=86400000, buckets=10):
+    # Where on the current dynamic playlist the explicitly reported plays of the latest session fall, in tenths
+    # of the playlist. Inferred plays are excluded, since they always cover the start of the playlist.
+    explicit = history_df[history_df['meta_batch'] > 0]
+    if explicit.empty or dynamic_df.empty:
+        return None
+    session = explicit[explicit['played_at_timestamp'] > explicit['played_at_timestamp'].max() - session_ms]
+    # A song can be on the playlist twice; each play is counted at its first position.
+    first_positions = dynamic_df['track_id'].reset_index(drop=True).drop_duplicates(keep='first')
+    codes = pd.Index(first_positions).get_indexer(session['track_id'])
+    positions = first_positions.index.to_numpy()[codes[codes >= 0]]
+    if len(positions) == 0:
+        return None
+    bucket_counts = np.bincount(positions * buckets // len(dynamic_df), minlength=buckets)
+    expected = len(positions) / buckets
+    chi_square = float(((bucket_counts - expected) ** 2).sum() / expected)
+    return {'plays': len(positions), 'bucket_counts': bucket_counts.tolist(),
+            'chi_square': round(chi_square, 1), 'chi_square_p_value': chi_square_p_value(chi_square, buckets - 1)}
+
+
+def audit_shuffle(storage_filepath):
+    # Runs the audit over the full listening history and saves the results to shuffle_audit.csv.
+    # Reads the current published generation, so a running pipeline can't change the files part-way through.
+    start_time = time.perf_counter()
+    generation_path = current_generation_path(storage_filepath)
+    history_df = pd.read_csv(generation_file(storage_filepath, 'listen_history.csv', generation_path),
+                             usecols=['played_at_timestamp', 'track_id', 'meta_batch', 'played_on_tracked_list'])
+    tracked_df = pd.read_csv(generation_file(storage_filepath, 'all_tracked_songs.csv', generation_path))
+    dynamic_df = pd.read_csv(generation_file(storage_filepath, 'dynamic_songs.csv', generation_path))
+
+    # Oldest play first, so array position is play order.
+    history_df = history_df.sort_values('played_at_timestamp', kind='stable').reset_index(drop=True)
+    tracked_ids = pd.Index(tracked_df['track_id'].dropna().unique())
+    track_codes = tracked_ids.get_indexer(history_df['track_id'])
+    on_tracked_list = (history_df['played_on_tracked_list'] == True).to_numpy()
+    inferred = (history_df['meta_batch'] == 0).to_numpy()
+    is_tracked_song = track_codes >= 0
+
+    groups = {'all plays': np.ones(len(history_df), dtype=bool),
+              'played on tracked list': on_tracked_list,
+              'not played on tracked list': ~on_tracked_list,
+              'explicit plays (meta_batch > 0)': ~inferred,
+              'inferred plays (meta_batch = 0)': inferred}
+    results = [audit_group(group_name, track_codes[group_mask & is_tracked_song], len(tracked_ids))
+               for group_name, group_mask in groups.items()]
+    results_df = pd.DataFrame(results)
+    atomic_to_csv(results_df, os.path.join(storage_filepath, 'shuffle_audit.csv'))
+
+    pd.set_option('display.width', 250)
+    pd.set_option('display.max_columns', 30)
+    print('__________________________________________________')
+    print('Shuffle audit over', len(history_df), 'plays and', len(tracked_ids), 'tracked songs:')
+    print(results_df.set_index('group').T.to_string())
+    print('A fair shuffle has a dispersion index near 1, a chi-square p-value that is not tiny, and a short '
+          'repeat percentage close to the expected one.')
+
+    bias = position_bias(history_df, dynamic_df)
+    if bias is not None:
+        print('Dynamic playlist position of', bias['plays'], 'explicit plays in the latest session, by tenth:',
+              bias['bucket_counts'], '| chi-square', bias['chi_square'],
+              'p-value', '{:.3g}'.format(bias['chi_square_p_value']))
+    print('Audit completed in', round(time.perf_counter() - start_time, 2), 'seconds; saved to shuffle_audit.csv')
+    return results_df
+
+
+if __name__ == '__main__':
+    audit_shuffle(sys.argv[1])
@@ -9,6 +9,22 @@ from spotipy.oauth2 import SpotifyOAuth
 from difflib import SequenceMatcher
 import numpy as np
 import re
+import heapq
+from functools import cmp_to_key
+from file_storage import atomic_open, atomic_to_csv, atomic_write_text, file_fingerprint
+from run_journal import cached_batch, fingerprint, stage_unchanged, record_fingerprint
+from playlist_ordering import tempo_curve_order, ranking_order, duration_budget_selection, artist_spacing_order, \
+    spacing_violations
+from removals_ledger import ledger_columns, read_removals_ledger, write_removals_ledger, record_removals, \
+    restore_readded
+from ordering_archive import record_ordering
+from substitution_decisions import track_metadata_hash, read_substitution_decisions, write_substitution_decisions
+from play_rollup import (read_play_rollup, refresh_play_rollup, update_play_rollup, replace_rollup_track_id,
+                         rollup_last_played, rollup_window_counts, history_signature)
+
+# Star value -> days of recent play history counted when ranking a song. Edit to change how often each
+# star level comes back around.
+star_intervals = {5: 14, 4: 21, 3: 42, 2: 56, 1: 70}
 
 def print_break():
     print('__________________________________________________')
@@ -42,7 +58,7 @@ def local_storage_init(filepath):
         if not os.path.exists(rankings):
             column_list = ['track_id', 'track_name', 'artist_name', 'duration_ms', 'star_rating']
             df = pd.DataFrame(columns=column_list)
-            df.to_csv(rankings, index=False)
+            atomic_to_csv(df, rankings)
             print('Rankings file initialized.')
 
         # Test for and create the listening history file if it does not exist:
@@ -51,32 +67,14 @@ def local_storage_init(filepath):
             column_list = ['track_name', 'artist_name', 'album_name', 'played_at', 'played_at_timestamp', 'duration_ms',
                            'track_id', 'popularity', 'meta_batch', 'is_running_song', 'played_on_tracked_list']
             df = pd.DataFrame(columns=column_list)
-            df.to_csv(listen_history, index=False)
+            atomic_to_csv(df, listen_history)
             print('Listening history file initialized.')
 
         # Test for and create the playlist removals file if it does not exist.
         playlist_removals = os.path.join(filepath, 'playlist_removals.csv')
         if not os.path.exists(playlist_removals):
-            column_list = ['track_id',
-                           'track_name',
-                           'track_popularity',
-                           'track_duration_ms',
-                           'artist_name',
-                           'artist_id',
-                           'album_name',
-                           'album_id',
-                           'duration_ms',
-                           'stars',
-                           'last_played',
-                           '5_star_recent_plays',
-                           '4_star_recent_plays',
-                           '3_star_recent_plays',
-                           '2_star_recent_plays',
-                           '1_star_recent_plays',
-                           'star_plays',
-                           'ranking']
-            df = pd.DataFrame(columns=column_list)
-            df.to_csv(playlist_removals, index=False)
+            df = pd.DataFrame(columns=ledger_columns)
+            atomic_to_csv(df, playlist_removals)
             print('Playlist removal file initialized.')
     except Exception as e:
         print('Error validating local files: ', e)
@@ -121,8 +119,7 @@ def read_login(cred_path, service, login_type):
         print('Please input your', login_type, 'for', service)
         result = input('Input --> ')
         # Save the input locally
-        with open(cred_file, 'w') as f:
-            f.write(result)
+        atomic_write_text(cred_file, result)
     return result
 
 def attempt_login(cred_path):
@@ -201,23 +198,65 @@ def get_playlist_id(storage_loc, playlist_type):
         print('(Playlist ID can be found at the end of the web URL for the playlist)')
         result = input('Input --> ')
         # Save the input locally
-        with open(id_file, 'w') as f:
-            f.write(result)
+        atomic_write_text(id_file, result)
     return result
 
+class TrackColumns:
+    # Builds dataframe columns straight from the track objects of API pages, one list per column, instead of a
+    # dict per track. Shared by synchronize_playlist and get_recently_played.
+    __slots__ = ('album_id', 'album_name', 'artist_id', 'artist_name', 'track_id', 'track_name', 'popularity',
+                 'duration_ms', 'played_at', 'played_at_timestamp', 'meta_batch')
+
+    def __init__(self):
+        for column in self.__slots__:
+            setattr(self, column, [])
+
+    def add_track(self, track):
+        artist = track['artists'][0] if track['artists'] else None
+        self.album_id.append(track['album']['id'])
+        self.album_name.append(track['album']['name'])
+        self.artist_id.append(artist['id'] if artist else None)
+        self.artist_name.append(artist['name'] if artist else None)
+        self.track_id.append(track['id'])
+        self.track_name.append(track['name'])
+        self.popularity.append(track['popularity'])
+        self.duration_ms.append(track['duration_ms'])
+
+    def add_playlist_items(self, items):
+        for item in items:
+            if item['track'] is not None:
+                self.add_track(item['track'])
+
+    def add_play(self, track, played_at, played_at_timestamp, meta_batch):
+        self.add_track(track)
+        self.played_at.append(played_at)
+        self.played_at_timestamp.append(played_at_timestamp)
+        self.meta_batch.append(meta_batch)
+
+    def to_dataframe(self, column_list, **constant_columns):
+        # constant_columns: columns with the same value on every row, e.g. is_tracked_song=False.
+        row_count = len(self.track_id)
+        return pd.DataFrame({column: [constant_columns[column]] * row_count if column in constant_columns
+                             else getattr(self, column) for column in column_list})
+
+
+playlist_columns = ['album_id', 'album_name', 'artist_id', 'artist_name', 'track_id', 'track_name', 'popularity',
+                    'duration_ms']
+
+
 def synchronize_playlist(sp, storage_loc, playlist_type):
     # This will look for the playlist id of the specified type, asking the user for input if it does not exist.
     # Then it will attempt to read that playlist id from spotify, and synchronize it locally as a CSV Fuke
     print_break()
     print('Beginning synchronization of', playlist_type + '.')
-    track_data = []
+    track_columns = TrackColumns()
 
     # Retrieve or have user input Playlist ID
     list_id = get_playlist_id(storage_loc, playlist_type)
 
     # Get the track list for Playlist ID
     try:
-        results = sp.playlist_tracks(list_id)
+        results = cached_batch(storage_loc, playlist_type + '_batch_1', lambda: sp.playlist_tracks(list_id))
         print(playlist_type, 'batch #1 received.')
     except Exception as e:
         print('Unable to retrieve track list:', e)
@@ -226,38 +265,19 @@ def synchronize_playlist(sp, storage_loc, playlist_type):
         print('Terminating script.')
         sys.exit(1)
 
-    tracks = results['items']
+    # Each page of JSON results is converted into columns as it arrives.
+    track_columns.add_playlist_items(results['items'])
     batch = 2
     while results['next']:
-        results = sp.next(results)
-        tracks.extend(results['items'])
+        results = cached_batch(storage_loc, playlist_type + '_batch_' + str(batch), lambda: sp.next(results))
+        track_columns.add_playlist_items(results['items'])
         print(playlist_type, 'batch #' + str(batch), 'received.')
         batch += 1
 
-    # Convert the JSON results so they can be read into a dataframe.
-    for item in tracks:
-        if item['track'] is None:
-            continue
-
-        track = item['track']
-
-        # Compile track information
-        track_info = {
-            'album_id': track['album']['id'],
-            'album_name': track['album']['name'],
-            'artist_id': track['artists'][0]['id'] if track['artists'] else None,
-            'artist_name': track['artists'][0]['name'] if track['artists'] else None,
-            'track_id': track['id'],
-            'track_name': track['name'],
-            'popularity': track['popularity'],
-            'duration_ms': track['duration_ms']
-        }
-        track_data.append(track_info)
-
     # Convert to dataframe and save to CSV.
-    playlist_df = pd.DataFrame(track_data)
+    playlist_df = track_columns.to_dataframe(playlist_columns)
     playlist_file = os.path.join(storage_loc, playlist_type) + '.csv'
-    playlist_df.to_csv(playlist_file, index=False)
+    atomic_to_csv(playlist_df, playlist_file)
     print(len(playlist_df), 'songs synchronized from', playlist_type, 'and saved to', playlist_file)
 
 def get_sync_date(filepath):
@@ -355,7 +375,7 @@ def get_recently_played(sp, filepath, tracked_only):
           format_timestamp(api_ts)), ' || ', ts_difference(prior_sync_ts, api_ts)
 
     # initialize local variables
-    all_tracks = []  # empty track list
+    track_columns = TrackColumns()  # column buffers for the plays retrieved
     more_tracks = True  # retrieve an additional batch of tracks
     batch = 0  # keep track of the number of batches we have retrieved from the API
     batch_repeat = 0
@@ -366,7 +386,9 @@ def get_recently_played(sp, filepath, tracked_only):
         print('Starting batch #', batch, 'for songs before:', format_timestamp(api_ts))
 
         # Return list of the 50 most recently played songs played prior to before_ts
-        results = sp.current_user_recently_played(limit=50, before=api_ts)
+        # Batches already fetched by an unfinished earlier run are re-used from the run cache.
+        results = cached_batch(filepath, 'recently_played_batch_' + str(batch),
+                               lambda: sp.current_user_recently_played(limit=50, before=api_ts))
         # results = sp.current_user_recently_played(limit=50)
 
         if not results['items']:
@@ -390,22 +412,12 @@ def get_recently_played(sp, filepath, tracked_only):
                 more_tracks = False
                 break
 
-            # Add to our list
-            track = item['track']
-            track_data = {
-                'track_name': track['name'],
-                'artist_name': track['artists'][0]['name'],
-                'album_name': track['album']['name'],
-                'played_at': played_at,
-                'played_at_timestamp': track_ts,
-                'duration_ms': track['duration_ms'],
-                'track_id': track['id'],
-                'popularity': track['popularity'],
-                'meta_batch': batch,
-                'is_tracked_song': False,  # used later when compared against the tracked playlist
-                'played_on_tracked_list': False
-            }
-            all_tracks.append(track_data)
+            # A play at exactly the last synchronized timestamp is already in the local history.
+            if track_ts == prior_sync_ts:
+                continue
+
+            # Add to our columns
+            track_columns.add_play(item['track'], played_at, track_ts, batch)
             # End of batch iteration loop.
 
         # Test if we need to retrieve another batch.
@@ -432,8 +444,8 @@ def get_recently_played(sp, filepath, tracked_only):
     column_list = ['track_name', 'artist_name', 'album_name', 'played_at', 'played_at_timestamp',
                    'duration_ms', 'track_id', 'popularity', 'meta_batch', 'is_tracked_song', 'played_on_tracked_list']
 
-    # Convert api results into a dataframe.
-    recent_tracks_df = pd.DataFrame(all_tracks, columns=column_list)
+    # Convert api results into a dataframe. is_tracked_song is set later by comparing against the tracked playlist.
+    recent_tracks_df = track_columns.to_dataframe(column_list, is_tracked_song=False, played_on_tracked_list=False)
 
 
     # Read the complete running playlist into a dataframe
@@ -450,7 +462,7 @@ def get_recently_played(sp, filepath, tracked_only):
     # Restrict column output of dataframe and write to csv.
     recent_tracks_df = recent_tracks_df[column_list]
     recently_played_file = os.path.join(filepath, 'recently_played.csv')
-    recent_tracks_df.to_csv(recently_played_file, index=False)
+    atomic_to_csv(recent_tracks_df, recently_played_file)
     print(len(recent_tracks_df), 'recently played songs retrieved and saved to', recently_played_file)
     return len(recent_tracks_df)
     # Function over.
@@ -485,7 +497,12 @@ def value_replace(filepath, filename, old_value, new_value, col_name='track_id')
         print('!!! Replacement failed,', col_name, 'is not a valid column.')
     else:
         df[col_name] = df[col_name].replace(old_value, new_value)
-        df.to_csv(fn)
+        atomic_to_csv(df, fn)
+
+def substitution_candidate(name_score, artist_score, album_score, duration_match_pct, threshold):
+    # True when a recently played track looks like Spotify's substitute for a playlist track.
+    return name_score > threshold or ((name_score > threshold/2 and duration_match_pct < 0.05) and
+                                      (album_score > threshold/2 or artist_score > threshold / 1.5))
 
 def infer_updated_track_ids(storage_filepath, threshold=0.9):
     recent_fn = os.path.join(storage_filepath, 'recently_played.csv')
@@ -500,6 +517,23 @@ def infer_updated_track_ids(storage_filepath, threshold=0.9):
         print_break()
         print('Testing', len(recent_df),
               'recent songs for Spotify Substitutions, with a similarity threshold of', threshold)
+
+        # Scores and answers from earlier runs, keyed by (recent track id, playlist track id).
+        decisions = read_substitution_decisions(storage_filepath)
+        seen_pairs = set()
+        pairs_scored = 0
+        pairs_reused = 0
+
+        # Clean the playlist track names once, rather than once per recent song.
+        playlist_tracks = [(playlist_track['track_id'],
+                            remove_remastered(playlist_track['track_name']),
+                            remove_remastered(playlist_track['artist_name']),
+                            remove_remastered(playlist_track['album_name']),
+                            playlist_track['duration_ms'],
+                            track_metadata_hash(playlist_track['track_name'], playlist_track['artist_name'],
+                                                playlist_track['album_name'], playlist_track['duration_ms']))
+                           for _, playlist_track in dynamic_df.iterrows()]
+
         # Test the songs in recent history 1x1
         for r_id, recent_track in recent_df.iterrows():
             recent_track_id = recent_track['track_id']
@@ -507,53 +541,85 @@ def infer_updated_track_ids(storage_filepath, threshold=0.9):
             recent_track_artist = remove_remastered(recent_track['artist_name'])
             recent_track_album = remove_remastered(recent_track['album_name'])
             recent_track_duration = recent_track['duration_ms']
+            recent_hash = track_metadata_hash(recent_track['track_name'], recent_track['artist_name'],
+                                              recent_track['album_name'], recent_track_duration)
 
             # Test against the songs in the dynamic track 1x1
-            for p_id, playlist_track in dynamic_df.iterrows():
-                playlist_track_id = playlist_track['track_id']
+            for (playlist_track_id, playlist_track_name, playlist_track_artist, playlist_track_album,
+                 playlist_track_duration, playlist_hash) in playlist_tracks:
                 exact_match = recent_track_id == playlist_track_id
 
                 # Exclude all the exact matches
-                if not exact_match:
-                    playlist_track_name = remove_remastered(playlist_track['track_name'])
-                    playlist_track_artist = remove_remastered(playlist_track['artist_name'])
-                    playlist_track_album = remove_remastered(playlist_track['album_name'])
-                    playlist_track_duration = playlist_track['duration_ms']
+                if exact_match:
+                    continue
+
+                # Re-use the scores of a known pair, unless either track's details have changed since.
+                pair = (recent_track_id, playlist_track_id)
+                seen_pairs.add(pair)
+                known = decisions.get(pair)
+                if known is not None and known['recent_hash'] == recent_hash \
+                        and known['playlist_hash'] == playlist_hash:
+                    pairs_reused += 1
+                    # Already accepted or rejected, go to next song in dynamic file
+                    if known['decision']:
+                        continue
+                else:
+                    pairs_scored += 1
                     duration_match_pct = abs(recent_track_duration - playlist_track_duration) / playlist_track_duration
-                    name_score = string_similarity(playlist_track_name, recent_track_name)
-                    artist_score = string_similarity(playlist_track_artist, recent_track_artist)
-                    album_score = string_similarity(playlist_track_album, recent_track_album)
-
-                    # When a potential match is detected, display relevant information and ask the user to accept/reject
-                    if name_score > threshold or ((name_score > threshold/2 and duration_match_pct < 0.05) and
-                             (album_score > threshold/2 or artist_score > threshold / 1.5)):
-                        print('****** POTENTIAL REPLACEMENT NEEDED ******')
-                        print('Track (', round(name_score, 2), ') ||', recent_track_name[:40],
-                              '(r) vs', playlist_track_name[:40], '(p)')
-                        print('Artist (', round(artist_score, 2), ') ||', recent_track_artist[:40],
-                              '(r) vs', playlist_track_artist[:40], '(p)')
-                        print('Album (', round(album_score, 2), ') ||', recent_track_album[:40],
-                              '(r) vs', playlist_track_album[:40], '(p)')
-                        print('Duration ||', int(recent_track_duration / 1000), '(r) vs',
-                              int(playlist_track_duration / 1000), '(p) - pct:',
-                              str(round(duration_match_pct*100,1)) + '%' )
-                        accept_replacement = input('Accept replacement (Y/N) --> ')
-
-                        # If the replacement is acceptable, swap the value across relevant files.
-                        if accept_replacement == 'y' or accept_replacement == 'Y':
-                            print('Swapping', playlist_track_id, 'for', recent_track_id)
-                            value_replace(storage_filepath, 'rankings',
-                                          playlist_track_id, recent_track_id)
-                            value_replace(storage_filepath, 'dynamic_songs',
-                                          playlist_track_id, recent_track_id)
-                            value_replace(storage_filepath, 'all_tracked_songs',
-                                          playlist_track_id, recent_track_id)
-                            value_replace(storage_filepath, 'listen_history',
-                                          playlist_track_id, recent_track_id)
-                        # Else no replacement desired, go to next song in dynamic file
-                    # Else below replacement threshold, go to next song in dynamic file
-                # Else is already an exact match, skipping, go to next song in dynamic file.
+                    known = {'recent_track_id': recent_track_id,
+                             'playlist_track_id': playlist_track_id,
+                             'recent_hash': recent_hash,
+                             'playlist_hash': playlist_hash,
+                             'name_score': string_similarity(playlist_track_name, recent_track_name),
+                             'artist_score': string_similarity(playlist_track_artist, recent_track_artist),
+                             'album_score': string_similarity(playlist_track_album, recent_track_album),
+                             'duration_match_pct': duration_match_pct,
+                             'decision': ''}
+                    decisions[pair] = known
+                name_score = known['name_score']
+                artist_score = known['artist_score']
+                album_score = known['album_score']
+                duration_match_pct = known['duration_match_pct']
+
+                # When a potential match is detected, display relevant information and ask the user to accept/reject
+                if substitution_candidate(name_score, artist_score, album_score, duration_match_pct, threshold):
+                    print('****** POTENTIAL REPLACEMENT NEEDED ******')
+                    print('Track (', round(name_score, 2), ') ||', recent_track_name[:40],
+                          '(r) vs', playlist_track_name[:40], '(p)')
+                    print('Artist (', round(artist_score, 2), ') ||', recent_track_artist[:40],
+                          '(r) vs', playlist_track_artist[:40], '(p)')
+                    print('Album (', round(album_score, 2), ') ||', recent_track_album[:40],
+                          '(r) vs', playlist_track_album[:40], '(p)')
+                    print('Duration ||', int(recent_track_duration / 1000), '(r) vs',
+                          int(playlist_track_duration / 1000), '(p) - pct:',
+                          str(round(duration_match_pct*100,1)) + '%' )
+                    accept_replacement = input('Accept replacement (Y/N) --> ')
+
+                    # If the replacement is acceptable, swap the value across relevant files.
+                    if accept_replacement == 'y' or accept_replacement == 'Y':
+                        known['decision'] = 'accepted'
+                        print('Swapping', playlist_track_id, 'for', recent_track_id)
+                        refresh_play_rollup(storage_filepath)
+                        value_replace(storage_filepath, 'rankings',
+                                      playlist_track_id, recent_track_id)
+                        value_replace(storage_filepath, 'dynamic_songs',
+                                      playlist_track_id, recent_track_id)
+                        value_replace(storage_filepath, 'all_tracked_songs',
+                                      playlist_track_id, recent_track_id)
+                        value_replace(storage_filepath, 'listen_history',
+                                      playlist_track_id, recent_track_id)
+                        replace_rollup_track_id(storage_filepath, playlist_track_id, recent_track_id)
+                    # Else no replacement desired, remembered so the pair is not asked about again.
+                    else:
+                        known['decision'] = 'rejected'
+                    write_substitution_decisions(storage_filepath, decisions)
+                # Else below replacement threshold, go to next song in dynamic file
             # Loop completed, go to next song in dynamic list.
+
+        # Keep every answered pair, and the scores of unanswered pairs still in the recent window.
+        decisions = {pair: known for pair, known in decisions.items() if known['decision'] or pair in seen_pairs}
+        write_substitution_decisions(storage_filepath, decisions)
+        print(pairs_reused, 'song pairs re-used from earlier runs,', pairs_scored, 'newly scored.')
         print('Spotify substitution testing complete.')
 
 def get_track_positions(recent_df, dynamic_df, shuffle_off):
@@ -630,7 +696,7 @@ def infer_history(storage_filepath, shuffle_off, ms_in_24_hours=86400000):
         inferred_plays_df['played_at'] = most_recent_played_at # inferred songs all have the same timestamp.
         inferred_plays_df['played_at_timestamp'] = most_recent_timestamp
         inferred_filename = os.path.join(storage_filepath, 'inferred.csv')
-        inferred_plays_df.to_csv(inferred_filename, index=False)
+        atomic_to_csv(inferred_plays_df, inferred_filename)
         print(len(inferred_plays_df), 'songs with inferred history and saved as', inferred_filename )
 
         # Combine the inferred history with recently played history
@@ -640,13 +706,112 @@ def infer_history(storage_filepath, shuffle_off, ms_in_24_hours=86400000):
         combined_df = combined_df.sort_values(by=['played_on_tracked_list', 'played_at_timestamp', 'track_id'],
                                               ascending=[False, False, True])
         combined_df = combined_df.drop_duplicates(subset=['played_at_timestamp', 'track_id'], keep='first')
-        combined_df.to_csv(recently_played_fn, index=False)
+        atomic_to_csv(combined_df, recently_played_fn)
     else:
         print('No inferred history gathered.')
 
-def merge_play_history(storage_filepath):
+class UnsortedHistoryError(Exception):
+    # Raised by the streaming merge when the history file is not in newest-first order.
+    pass
+
+def history_order(row_a, row_b, played_col, track_col, flag_col):
+    # Compares two history rows in listen_history.csv order: newest played_at first, then track_id, with
+    # plays from the tracked list ahead of other plays of the same song at the same time.
+    if row_a[played_col] != row_b[played_col]:
+        return -1 if row_a[played_col] > row_b[played_col] else 1
+    track_a = row_a[track_col] if isinstance(row_a[track_col], str) else '\uffff'
+    track_b = row_b[track_col] if isinstance(row_b[track_col], str) else '\uffff'
+    if track_a != track_b:
+        return -1 if track_a < track_b else 1
+    if bool(row_a[flag_col] == True) != bool(row_b[flag_col] == True):
+        return -1 if row_a[flag_col] == True else 1
+    return 0
+
+def stream_merge_play_history(storage_filepath, recent_df, column_list, chunk_size):
+    # Streaming version of the merge for very large histories. listen_history.csv is already sorted newest-first,
+    # so it is read chunk_size rows at a time and merged with the (sorted) recent plays. Rows come out in final
+    # order, the 5 minute same-song check only needs the last kept play of each song from the last few minutes,
+    # and output is written as it goes -- so memory stays around one chunk no matter how long the history is.
+    history_fn = os.path.join(storage_filepath, 'listen_history.csv')
+    played_col = column_list.index('played_at')
+    ts_col = column_list.index('played_at_timestamp')
+    track_col = column_list.index('track_id')
+    flag_col = column_list.index('played_on_tracked_list')
+
+    def compare(item_a, item_b):
+        return history_order(item_a[0], item_b[0], played_col, track_col, flag_col)
+
+    recent_df = recent_df.sort_values(by=['played_at', 'track_id', 'played_on_tracked_list'],
+                                      ascending=[False, True, False])
+    recent_rows = ((row, False) for row in recent_df.itertuples(index=False, name=None))
+
+    # The daily rollup is recalculated for the track-days of the recent plays, so collect the kept plays
+    # for those days along the way.
+    recent_keys = set(zip(recent_df['track_id'], recent_df['played_at'].str[:10]))
+    rollup_plays = []
+    dropped_history = []
+
+    def history_rows():
+        previous_row = None
+        for chunk in pd.read_csv(history_fn, chunksize=chunk_size):
+            for row in chunk[column_list].itertuples(index=False, name=None):
+                if previous_row is not None and history_order(previous_row, row, played_col, track_col,
+                                                              flag_col) > 0:
+                    raise UnsortedHistoryError()
+                previous_row = row
+                yield row, True
+
+    history_count = 0
+    cleaned_count = 0
+    last_kept_ts = {}
+    output_rows = []
+    with atomic_open(history_fn) as f:
+        f.write(','.join(column_list) + '\n')
+        for row, from_history in heapq.merge(history_rows(), recent_rows, key=cmp_to_key(compare)):
+            history_count += from_history
+            track_id = row[track_col]
+            track_ts = row[ts_col]
+
+            # Skip the play if the same song was kept less than 5 minutes later.
+            if isinstance(track_id, str) and track_id in last_kept_ts \
+                    and abs(last_kept_ts[track_id] - track_ts) < 300000:
+                if from_history:
+                    dropped_history.append(row)
+                continue
+
+            if isinstance(track_id, str):
+                last_kept_ts[track_id] = track_ts
+            if (track_id, str(row[played_col])[:10]) in recent_keys:
+                rollup_plays.append(row)
+            output_rows.append(row)
+            cleaned_count += 1
+
+            if len(output_rows) >= chunk_size:
+                # Songs kept more than an hour (plus 5 minutes) ago can no longer match anything still to come.
+                last_kept_ts = {key: value for key, value in last_kept_ts.items()
+                                if value - track_ts < 300000 + 3600000}
+                pd.DataFrame(output_rows, columns=column_list).to_csv(f, header=False, index=False)
+                output_rows = []
+        pd.DataFrame(output_rows, columns=column_list).to_csv(f, header=False, index=False)
+
+    # A dropped history play outside the recent track-days needs its day's remaining plays as well.
+    dropped_df = pd.DataFrame(dropped_history, columns=column_list)
+    extra_keys = set(zip(dropped_df['track_id'], dropped_df['played_at'].astype(str).str[:10])) - recent_keys
+    if extra_keys:
+        for chunk in pd.read_csv(history_fn, chunksize=chunk_size):
+            chunk_keys = pd.Series(list(zip(chunk['track_id'], chunk['played_at'].astype(str).str[:10])),
+                                   index=chunk.index)
+            rollup_plays.extend(chunk.loc[chunk_keys.isin(extra_keys), column_list].itertuples(index=False,
+                                                                                                name=None))
+    update_play_rollup(storage_filepath, pd.DataFrame(rollup_plays, columns=column_list),
+                       pd.concat([recent_df, dropped_df]))
+    return history_count, cleaned_count
+
+def merge_play_history(storage_filepath, chunk_size=None):
     # Merges the recent play history with the running play history file, removing the record of any song played
     # multiple times in a 5 minute timespan.
+    # If chunk_size is set, the history is merged in a streaming pass of chunk_size rows at a time
+    # instead of being loaded into memory all at once.
 
     # Read in the recent history.
     recent_fn = os.path.join(storage_filepath, 'recently_played.csv')
@@ -661,6 +826,19 @@ def merge_play_history(storage_filepath):
         recent_df = recent_df[column_list]
 
         history_fn = os.path.join(storage_filepath, 'listen_history.csv')
+        refresh_play_rollup(storage_filepath)
+
+        if chunk_size:
+            try:
+                history_count, cleaned_count = stream_merge_play_history(storage_filepath, recent_df,
+                                                                         column_list, chunk_size)
+                print(len(recent_df), 'recently played songs merged with', history_count, 'songs of history.')
+                print('When cleaned, ', cleaned_count, 'played songs remain in history.')
+                print('Updated history saved to', history_fn)
+                return
+            except UnsortedHistoryError:
+                # The in-memory merge below re-sorts the file, so streaming will work on the next run.
+                print('History file is not sorted newest-first, merging in memory instead.')
 
         # Initialize play history and recent history
         history_df = pd.read_csv(history_fn)
@@ -716,7 +894,13 @@ def merge_play_history(storage_filepath):
         cleaned_df = cleaned_df.reset_index(drop=True)
 
         # Write dataframe to csv
-        cleaned_df.to_csv(history_fn, index=False)
+        atomic_to_csv(cleaned_df, history_fn)
+
+        # Update the daily play rollup for the plays that were added, and any history rows that were collapsed.
+        removed_df = history_df.merge(cleaned_df[['track_id', 'played_at_timestamp']],
+                                      on=['track_id', 'played_at_timestamp'], how='left', indicator=True)
+        removed_df = removed_df[removed_df['_merge'] == 'left_only']
+        update_play_rollup(storage_filepath, cleaned_df, pd.concat([recent_df, removed_df[column_list]]))
         print(len(recent_df), 'recently played songs merged with', len(history_df), 'songs of history.')
         print('When cleaned, ', len(cleaned_df), 'played songs remain in history.')
         print('Updated history saved to', history_fn)
@@ -810,24 +994,58 @@ def star_plays(row):
     col_name = str(star_value) + '_star_recent_plays'
     return row[col_name]
 
-def update_rankings(storage_filepath, tracked_only):
+def rankings_fingerprint(storage_filepath, tracked_only, intervals, tempo_curve_songs, artist_gap=0, album_gap=0):
+    # Hashes everything update_rankings reads: daily play counts, ratings, the tracked playlist snapshot,
+    # and the ranking policy. The date is included because the play-count windows are relative to today.
+    # The tracked playlist is hashed in track_id order, since re-ordering it is this script's own doing.
+    tracked_df = pd.read_csv(os.path.join(storage_filepath, 'all_tracked_songs.csv'))
+    tracked_snapshot = tracked_df.sort_values('track_id')[['track_id', 'track_name', 'artist_name', 'album_id',
+                                                           'duration_ms']].values.tolist()
+    return fingerprint(file_fingerprint(os.path.join(storage_filepath, 'play_rollup.csv')),
+                       history_signature(storage_filepath),
+                       file_fingerprint(os.path.join(storage_filepath, 'rankings.csv')),
+                       tracked_snapshot,
+                       file_fingerprint(os.path.join(storage_filepath, 'audio_features.csv')),
+                       tracked_only,
+                       sorted(intervals.items()),
+                       tempo_curve_songs,
+                       artist_gap,
+                       album_gap,
+                       datetime.now(pytz.UTC).date())
+
+def update_rankings(storage_filepath, tracked_only, intervals=None, tempo_curve_songs=None, artist_gap=0,
+                    album_gap=0):
     # Loads the play history and running files. Calculates listening stats by star level.
     # Asks users to update ratings for recently played and 0-star songs.
     # Writes an updated rankings file which is later used to re-write playlists.
+    # If tempo_curve_songs is set, the top X songs are re-ordered into a warm-up / steady / finish tempo curve
+    # using the cached audio features.
+    # artist_gap / album_gap keep at least that many other songs between songs by the same artist / from the
+    # same album, moving songs as little as possible from their ranked position.
     print_break()
+    if intervals is None:
+        intervals = star_intervals
+
+    # Skip the recalculation if nothing has changed since the rankings file was last written. The rollup is
+    # brought in line with the listening history first, in case the history was changed outside this script.
+    refresh_play_rollup(storage_filepath)
+    inputs_fingerprint = rankings_fingerprint(storage_filepath, tracked_only, intervals, tempo_curve_songs,
+                                              artist_gap, album_gap)
+    if stage_unchanged(storage_filepath, 'update_rankings', inputs_fingerprint):
+        print('No new plays, playlist or rating changes. Existing rankings re-used.')
+        return
+
     print('Updating dynamic ranking calculations.')
     rankings_fn = os.path.join(storage_filepath, 'rankings.csv')
-    history_fn = os.path.join(storage_filepath, 'listen_history.csv')
     tracked_fn = os.path.join(storage_filepath, 'all_tracked_songs.csv')
 
-    # Initialize the dataframes for ratings, listening history, and the tracked song playlist.
+    # Initialize the dataframes for ratings, daily play counts, and the tracked song playlist.
     rankings_df = pd.read_csv(rankings_fn)
-    history_df = pd.read_csv(history_fn)
+    rollup_df = read_play_rollup(storage_filepath)
     tracked_df = pd.read_csv(tracked_fn)
 
     # Keep a record of any songs that have been removed from the running playlist.
-    playlist_removals_file = os.path.join(storage_filepath, 'playlist_removals.csv')
-    removals_df = pd.read_csv(playlist_removals_file)
+    removals_ledger = read_removals_ledger(storage_filepath)
 
     # Create a dataframe of songs ON the playlist BUT NOT IN the ratings file.
     tracks_to_add = tracked_df[~tracked_df['track_id'].isin(rankings_df['track_id'])]
@@ -841,7 +1059,11 @@ def update_rankings(storage_filepath, tracked_only):
     # Add songs from the running playlist to the rating playlist with a default star value of zero.
     if not tracks_to_add.empty:
         print('Adding ', len(tracks_to_add), ' tracks to rankings')
-        tracks_to_add['star_rating'] = 0
+        # Songs that were on the playlist before get their previous rating back.
+        restored_ratings = restore_readded(removals_ledger, tracks_to_add['track_id'])
+        tracks_to_add['star_rating'] = tracks_to_add['track_id'].map(restored_ratings).fillna(0).astype(int)
+        if restored_ratings:
+            print(len(restored_ratings), 're-added tracks restored to their previous star rating.')
         common_cols = [col for col in rankings_df.columns if col in tracks_to_add.columns]
         tracks_to_add_subset = tracks_to_add[common_cols]
 
@@ -852,51 +1074,32 @@ def update_rankings(storage_filepath, tracked_only):
         updated_ratings = pd.concat([updated_ratings, tracks_to_add_subset[rankings_df.columns]],
                                     ignore_index=True)
 
-    # Remove songs from the rating file that are no longer on the running playlist.
-    if not tracks_to_remove.empty:
-        removals_df =pd.concat([removals_df, tracks_to_remove], ignore_index=True)
-        removals_df.to_csv(playlist_removals_file, index=False)
-
-    # Ensure datetime format compliance
-    history_df = dt_standardize(history_df, 'played_at')
+    # Remove songs from the rating file that are no longer on the running playlist. The ledger is saved once the
+    # new rankings file is written.
+    removals_ledger, removed_count = record_removals(removals_ledger, tracks_to_remove)
 
     # Restrict to just the relevant columns
     column_list = ['track_id', 'track_name', 'artist_name', 'duration_ms', 'star_rating']
     updated_ratings = updated_ratings[column_list]
 
-    # Depending on user history, only calculate listening history if the songs were on the tracked list.
-    if tracked_only:
-        history_df = history_df[history_df['played_on_tracked_list']]
-
-    # Determine the max played at time for any given track.
-    last_played = history_df.groupby('track_id')['played_at'].max().reset_index()
-    last_played.rename(columns={'played_at': 'last_played'}, inplace=True)
+    # Determine the max played at time for any given track. Depending on user history, only plays from the
+    # tracked list are counted.
+    last_played = rollup_last_played(rollup_df, tracked_only)
     last_played = dt_standardize(last_played, 'last_played')
 
     # Merged last played information back into ratings file.
     updated_ratings = updated_ratings.merge(last_played, on='track_id', how='left')
 
-    # intervals = [5: 14, 30, 60, 90, 180]
-    # Create a dictionary that corresponds to the star values and the days of recent play history to calculate
-    intervals = {5: 14, 4: 21, 3: 42, 2: 56, 1: 70}
-
     # Set the current UTC timestamp so we have a point of comparison
     today = datetime.now(pytz.UTC)
 
-    # Iterate through the dictionary and build columns
+    # Count the number of times each track was played in the last x days, for each star level's x.
+    window_counts = rollup_window_counts(rollup_df, sorted(set(intervals.values())), today, tracked_only)
     for star_ranking, days_value in intervals.items():
-        # Set the day I'm comparing against.
-        days_ago = today - timedelta(days = days_value)
-
-        # Limit the dataframe to just songs played more recently than that date.
-        recent_plays = history_df[pd.to_datetime(history_df['played_at']) >= days_ago]
-
-        # Count the number of times the track was played in the last x days
-        play_count = recent_plays.groupby('track_id').size().reset_index()
-
         # Dynamically name the new column
         col_name = str(star_ranking) + '_star_recent_plays'
-        play_count.rename(columns={0: col_name}, inplace=True)
+        play_count = window_counts[['track_id', days_value]].rename(columns={days_value: col_name})
+        play_count = play_count[play_count[col_name] > 0]
 
         # Merge the new columns with the existing dataframe.
         updated_ratings = updated_ratings.merge(play_count, on='track_id', how='left')
@@ -926,20 +1129,64 @@ def update_rankings(storage_filepath, tracked_only):
     updated_ratings['star_plays'] = updated_ratings['star_plays'].fillna(0)
     updated_ratings['last_played'] = updated_ratings['last_played'].fillna('2020-01-01T01:01:01.001Z')
     updated_ratings = dt_standardize(updated_ratings, 'last_played')
-    updated_ratings['random_num'] = np.random.randint(1,len(updated_ratings) * 2, size=len(updated_ratings))
+    # The tiebreak is seeded from the input fingerprint, so identical inputs always produce the identical order.
+    rng = np.random.default_rng(int(inputs_fingerprint[:16], 16))
+    updated_ratings['random_num'] = rng.integers(1, len(updated_ratings) * 2, size=len(updated_ratings))
 
     # Sort the dataframe by the least-played songs based on star values, then a bunch of tiebreakers.
-    sorted_ratings = updated_ratings.sort_values(by =['star_plays', 'random_num'],
-                                                 ascending=[True, True])
+    sorted_ratings = updated_ratings.iloc[ranking_order(updated_ratings['star_plays'].to_numpy(),
+                                                       updated_ratings['random_num'].to_numpy())]
+    # Keep the pure ranked position, since spacing and the tempo curve below re-order the file. Duration playlists
+    # are filled in this order.
+    sorted_ratings['priority'] = range(1, len(sorted_ratings) + 1)
+
+    # Space out songs by the same artist (and album). This is done on the full ranking, before the tempo curve, so
+    # it decides which songs make the dynamic playlist and the tempo curve only re-orders them.
+    album_lookup = tracked_df.drop_duplicates('track_id').set_index('track_id')['album_id']
+    if artist_gap or album_gap:
+        spaced_order, _ = artist_spacing_order(sorted_ratings['artist_name'].tolist(),
+                                               sorted_ratings['track_id'].map(album_lookup).tolist(),
+                                               artist_gap, album_gap)
+        sorted_ratings = sorted_ratings.iloc[spaced_order]
+
+    # Shape the songs headed for the dynamic playlist into a tempo curve, if audio features are available.
+    features_fn = os.path.join(storage_filepath, 'audio_features.csv')
+    if tempo_curve_songs and os.path.exists(features_fn):
+        features_df = pd.read_csv(features_fn)
+        sorted_ratings = sorted_ratings.merge(features_df, on='track_id', how='left')
+        sorted_ratings = tempo_curve_order(sorted_ratings, tempo_curve_songs)
+        if artist_gap or album_gap:
+            # The curve sorts the warm-up and finish songs by tempo and energy, which can bring an artist's songs
+            # together again. Space the curve itself, keeping as close to the curve order as the gaps allow.
+            top_df = sorted_ratings.head(tempo_curve_songs)
+            spaced_order, _ = artist_spacing_order(top_df['artist_name'].tolist(),
+                                                   top_df['track_id'].map(album_lookup).tolist(),
+                                                   artist_gap, album_gap)
+            sorted_ratings = pd.concat([top_df.iloc[spaced_order], sorted_ratings.iloc[tempo_curve_songs:]])
+        print('Top', tempo_curve_songs, 'songs ordered into a warm-up, steady, and finish tempo curve.')
+
+    if artist_gap or album_gap:
+        violations = spacing_violations(sorted_ratings['artist_name'].tolist(),
+                                        sorted_ratings['track_id'].map(album_lookup).tolist(),
+                                        artist_gap, album_gap)
+        print('Songs spaced at least', artist_gap, 'apart by artist and', album_gap, 'apart by album;',
+              violations, 'songs are closer than that to another by the same artist or album.')
 
     # Add a ranking for the new song order.
     sorted_ratings['ranking'] = range(1, len(sorted_ratings) + 1)
 
-    # Export the updated ratings file.
-    sorted_ratings.to_csv(rankings_fn, index=False)
+    # Export the updated ratings file, then the removals ledger that goes with it.
+    atomic_to_csv(sorted_ratings, rankings_fn)
+    if removed_count or not tracks_to_add.empty:
+        write_removals_ledger(storage_filepath, removals_ledger)
+    record_fingerprint(storage_filepath, 'update_rankings',
+                       rankings_fingerprint(storage_filepath, tracked_only, intervals, tempo_curve_songs,
+                                            artist_gap, album_gap))
     print('Updated rankings complete and saved to', rankings_fn)
 
-def update_playlist(sp, storage_path, playlist_name, num_songs=999):
+def update_playlist(sp, storage_path, playlist_name, num_songs=999, target_minutes=None):
+    # Re-writes the playlist with the top num_songs from the rankings file. If target_minutes is set, the playlist
+    # is instead filled, in ranking order, to as close to that total duration as possible.
     # Initialize the ratings file as a dataframe
     ratings_fn = os.path.join(storage_path, 'rankings.csv')
     ratings_df = pd.read_csv(ratings_fn)
@@ -958,26 +1205,53 @@ def update_playlist(sp, storage_path, playlist_name, num_songs=999):
     # Obtain the playlist ID of the set we are updating
     list_id = get_playlist_id(storage_path, playlist_name)
 
+    # Reduce the tracks to the specified number of songs, or the specified duration.
+    if target_minutes:
+        # Filled by ranking priority, not the spaced / tempo-curve order of the dynamic playlist.
+        ranked_df = ratings_df[ratings_df['track_id'].notna()]
+        if 'priority' in ranked_df.columns:
+            ranked_df = ranked_df.sort_values('priority', kind='stable')
+        ranked_ids = [str(track_id).strip() for track_id in ranked_df['track_id']]
+        durations = ranked_df['duration_ms'].fillna(0).to_numpy()
+        selected = duration_budget_selection(durations, target_minutes * 60000)
+        tracks_to_load = [ranked_ids[i] for i in selected]
+        loaded_minutes = durations[selected].sum() / 60000
+    else:
+        tracks_to_load = track_ids[:num_songs]
+    print_break()
+
+    # Skip the write calls if this exact order was written last time, and the playlist as synchronized at the
+    # start of this run still matches it (i.e. it hasn't been edited in Spotify since).
+    playlist_fingerprint = fingerprint(list_id, tracks_to_load)
+    snapshot_fn = os.path.join(storage_path, playlist_name + '.csv')
+    if stage_unchanged(storage_path, 'update_playlist_' + playlist_name, playlist_fingerprint) \
+            and os.path.exists(snapshot_fn) \
+            and pd.read_csv(snapshot_fn)['track_id'].dropna().astype(str).tolist() == tracks_to_load:
+        print(playlist_name, 'is already up to date, no changes sent to Spotify.')
+        return
+
     # Remove all songs from the existing, specified playlist.
     sp.playlist_replace_items(list_id, [])
 
-    # Reduce the tracks to the specified number of songs.
-    tracks_to_load = track_ids[:num_songs]
-    print_break()
     print('Updating', playlist_name, 'with ', len(tracks_to_load), 'songs.')
+    if target_minutes:
+        print('Target duration', target_minutes, 'minutes, loaded', round(loaded_minutes, 1), 'minutes.')
 
     # Initialize the batch size in case < 100 songs are requested
-    if num_songs < 100:
-        batch_size = num_songs
+    if len(tracks_to_load) < 100:
+        batch_size = max(len(tracks_to_load), 1)
     else:
         batch_size = 100
 
     # Batch the upload if longer than 100 items
     for i in range(0, len(tracks_to_load), batch_size):
-        batch = track_ids[i:i+batch_size]
+        batch = tracks_to_load[i:i+batch_size]
         sp.playlist_add_items(list_id, batch)
 
-    print('Finished updating', playlist_name, 'with ', len(tracks_to_load), 'songs.')
+    record_fingerprint(storage_path, 'update_playlist_' + playlist_name, playlist_fingerprint)
+    version = record_ordering(storage_path, playlist_name, tracks_to_load)
+    print('Finished updating', playlist_name, 'with ', len(tracks_to_load), 'songs.',
+          '(Archived as version', str(version) + ')')
 
 
 
@@ -0,0 +1,69 @@
+import os
+import time
+import cProfile
+import pstats
+import tracemalloc
+
+# Opt-in CPU and memory profiling of pipeline stages. Enable with profile_stages = True in
+# update_dynamic_playlist.py, or by setting the SPOTIFY_PROFILE environment variable to 1.
+# When disabled, stages are called directly and nothing here runs.
+profiling_enabled = os.environ.get('SPOTIFY_PROFILE', '0').lower() not in ('', '0', 'false', 'no')
+profile_dirname = 'profiles'
+stage_summaries = []
+
+
+def enable_profiling(enabled=True):
+    global profiling_enabled
+    profiling_enabled = enabled
+
+
+def profile_stage(storage_filepath, stage_name, func, *args, top_n=15, **kwargs):
+    # Runs one stage under cProfile and tracemalloc. Writes <stage>.pstats and <stage>_allocations.txt to the
+    # profiles folder of the storage location, and keeps a short summary for print_profile_summary().
+    profile_dir = os.path.join(storage_filepath, profile_dirname)
+    os.makedirs(profile_dir, exist_ok=True)
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start_time
+        snapshot = tracemalloc.take_snapshot()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        profiler.dump_stats(os.path.join(profile_dir, stage_name + '.pstats'))
+
+        allocations_fn = os.path.join(profile_dir, stage_name + '_allocations.txt')
+        with open(allocations_fn, 'w') as f:
+            f.write('Peak traced memory: ' + str(round(peak_bytes / 1048576, 2)) + ' MB\n')
+            f.write('Top ' + str(top_n) + ' allocation sites still held at the end of ' + stage_name + ':\n')
+            for stat in snapshot.statistics('lineno')[:top_n]:
+                f.write(str(stat) + '\n')
+
+        # Keep the three functions with the most time spent in their own code.
+        stats = pstats.Stats(profiler)
+        hot_functions = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:3]
+        stage_summaries.append({'stage': stage_name,
+                                'seconds': elapsed,
+                                'peak_mb': peak_bytes / 1048576,
+                                'hot_functions': [(pstats.func_std_string(func_key), own_time)
+                                                  for func_key, (_, _, own_time, _, _) in hot_functions]})
+
+
+def print_profile_summary():
+    # Prints the per-stage time, peak memory, and hottest functions collected during this run.
+    if not stage_summaries:
+        return
+    print('__________________________________________________')
+    print('Stage profile summary (timings include profiler overhead):')
+    for summary in stage_summaries:
+        print(summary['stage'], '--', str(round(summary['seconds'], 2)) + 's,',
+              'peak', str(round(summary['peak_mb'], 1)) + ' MB')
+        for func_name, own_time in summary['hot_functions']:
+            print('    ', str(round(own_time, 3)) + 's', func_name)
+    print('Profiles saved to the', profile_dirname, 'folder. Open with: python -m pstats <stage>.pstats')
@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import threading
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pandas as pd
+import pytz
+from play_rollup import rollup_rows, rollup_window_counts, rollup_last_played
+from spotify_functions import star_intervals
+from generations import current_generation_path, generation_file
+
+# A small read-only HTTP service over the local storage files, for checking rankings, last-played times and play
+# counts without opening Excel or re-running the script.
+#   python stats_service.py <local_file_storage_location> [port]
+# then browse to http://127.0.0.1:8765/
+#
+# Parsed files are kept in memory and only re-read when the file on disk changes. Each request reads the files of
+# the current published generation (see generations.py), so it sees one consistent set of files, and never holds
+# anything that would block the script from writing. While one request re-reads a changed file, other requests
+# keep being answered from the previous copy.
+
+endpoints = {
+    '/rankings': 'Current rankings. Optional ?limit=N',
+    '/tracks/<track_id>': 'Ranking, daily play counts and full play history of one song',
+    '/stats/windows': 'Plays per song in the last N days. Optional ?days=14,30&tracked_only=0',
+    '/stats/stars': 'Songs, plays inside their star window, and last play per star rating. Optional ?tracked_only=0',
+}
+
+
+class CachedFile:
+    # Holds the parsed contents of one storage file, re-parsed when the file changes. Where generations are hard
+    # links, unchanged files are the same file in every generation, so moving to a new generation only re-reads the
+    # files that changed.
+    def __init__(self, storage_filepath, filename, loader):
+        self.storage_filepath = storage_filepath
+        self.filename = filename
+        self.loader = loader
+        self.signature = None
+        self.value = None
+        self.reload_lock = threading.Lock()
+
+    def file_signature(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def get(self, generation_path):
+        path = generation_file(self.storage_filepath, self.filename, generation_path)
+        signature = self.file_signature(path)
+        if signature == self.signature:
+            return self.value
+
+        # Only one thread re-reads; others keep using the previous copy if there is one.
+        if not self.reload_lock.acquire(blocking=self.value is None):
+            return self.value
+        try:
+            signature = self.file_signature(path)
+            if signature != self.signature:
+                self.value = self.loader(path) if signature is not None else None
+                self.signature = signature
+            return self.value
+        finally:
+            self.reload_lock.release()
+
+
+def load_history(filename):
+    # Play history plus a track_id -> row positions index for O(1) per-song lookups.
+    history_df = pd.read_csv(filename)
+    return history_df, history_df.groupby('track_id').indices
+
+
+class StatsStore:
+    def __init__(self, storage_filepath):
+        self.storage_filepath = storage_filepath
+        self.rankings = CachedFile(storage_filepath, 'rankings.csv', pd.read_csv)
+        self.history = CachedFile(storage_filepath, 'listen_history.csv', load_history)
+        self.rollup = CachedFile(storage_filepath, 'play_rollup.csv', pd.read_csv)
+        self.window_cache = {}
+        self.window_cache_lock = threading.Lock()
+
+    def play_rollup(self, generation_path):
+        # Returns (rollup, signature of the file it came from).
+        rollup_df = self.rollup.get(generation_path)
+        if rollup_df is not None:
+            return rollup_df, self.rollup.signature
+        # The script has not built the rollup yet; derive it from the history without writing anything.
+        history = self.history.get(generation_path)
+        if not history:
+            return None, None
+        return rollup_rows(history[0].dropna(subset=['track_id', 'played_at'])), self.history.signature
+
+    def window_counts(self, window_days, tracked_only, generation_path):
+        # Cached per rollup (or history) version and UTC day, since windows are whole days.
+        rollup_df, signature = self.play_rollup(generation_path)
+        if rollup_df is None:
+            return None
+        today = datetime.now(pytz.UTC)
+        cache_key = (tuple(window_days), tracked_only, signature, today.date())
+        with self.window_cache_lock:
+            if cache_key in self.window_cache:
+                return self.window_cache[cache_key]
+        counts_df = rollup_window_counts(rollup_df, window_days, today, tracked_only)
+        counts_df = counts_df.merge(rollup_last_played(rollup_df, tracked_only), on='track_id', how='left')
+        with self.window_cache_lock:
+            self.window_cache = {key: value for key, value in self.window_cache.items()
+                                 if key[2] == signature}
+            self.window_cache[cache_key] = counts_df
+        return counts_df
+
+
+def frame_records(df):
+    # DataFrame -> list of dicts, with NaN as null.
+    return json.loads(df.to_json(orient='records'))
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        tracked_only = query.get('tracked_only', ['1'])[0] not in ('0', 'false')
+        path = url.path.rstrip('/')
+        # Every file this request reads comes from the same generation.
+        generation_path = current_generation_path(self.store.storage_filepath)
+
+        if path == '':
+            return self.send_json(200, endpoints)
+
+        if path == '/rankings':
+            rankings_df = self.store.rankings.get(generation_path)
+            if rankings_df is None:
+                return self.send_json(404, {'error': 'rankings.csv not found'})
+            try:
+                limit = int(query.get('limit', [len(rankings_df)])[0])
+            except ValueError:
+                return self.send_json(400, {'error': 'limit must be a whole number'})
+            return self.send_json(200, frame_records(rankings_df.head(limit)))
+
+        if path.startswith('/tracks/'):
+            track_id = path[len('/tracks/'):]
+            rankings_df = self.store.rankings.get(generation_path)
+            history = self.store.history.get(generation_path)
+            rollup_df = self.store.play_rollup(generation_path)[0]
+            ranking = rankings_df[rankings_df['track_id'] == track_id] if rankings_df is not None else None
+            plays = history[0].iloc[history[1].get(track_id, [])] if history else None
+            days = rollup_df[rollup_df['track_id'] == track_id] if rollup_df is not None else None
+            if (ranking is None or ranking.empty) and (plays is None or plays.empty):
+                return self.send_json(404, {'error': 'track not found', 'track_id': track_id})
+            return self.send_json(200, {
+                'track_id': track_id,
+                'ranking': frame_records(ranking)[0] if ranking is not None and not ranking.empty else None,
+                'daily_plays': frame_records(days) if days is not None else [],
+                'history': frame_records(plays) if plays is not None else []})
+
+        if path == '/stats/windows':
+            try:
+                window_days = sorted({int(days) for days in query.get('days', ['14,21,42,56,70'])[0].split(',')})
+            except ValueError:
+                return self.send_json(400, {'error': 'days must be a comma separated list of whole numbers'})
+            counts_df = self.store.window_counts(window_days, tracked_only, generation_path)
+            if counts_df is None:
+                return self.send_json(404, {'error': 'no listening history found'})
+            counts_df = counts_df.rename(columns={days: str(days) + '_day_plays' for days in window_days})
+            return self.send_json(200, frame_records(counts_df))
+
+        if path == '/stats/stars':
+            rankings_df = self.store.rankings.get(generation_path)
+            counts_df = self.store.window_counts(sorted(set(star_intervals.values())), tracked_only, generation_path)
+            if rankings_df is None or counts_df is None:
+                return self.send_json(404, {'error': 'rankings or listening history not found'})
+            stars_df = rankings_df[['track_id', 'star_rating']].merge(counts_df, on='track_id', how='left')
+            summary = []
+            for star_value, star_df in stars_df.groupby('star_rating'):
+                window = star_intervals.get(int(star_value) if star_value else 5)
+                if window is None:
+                    # Not a star rating the script ranks by (e.g. a typo in rankings.csv).
+                    continue
+                summary.append({'star_rating': int(star_value),
+                                'window_days': window,
+                                'songs': len(star_df),
+                                'plays_in_window': int(star_df[window].fillna(0).sum()),
+                                'last_played': star_df['last_played'].dropna().max() if star_df['last_played'].notna().any() else None})
+            return self.send_json(200, summary)
+
+        return self.send_json(404, {'error': 'unknown endpoint', 'endpoints': endpoints})
+
+    def log_message(self, format, *args):
+        # Keep the console quiet; errors are still returned to the caller.
+        pass
+
+
+def serve(storage_filepath, port=8765):
+    StatsRequestHandler.store = StatsStore(storage_filepath)
+    server = ThreadingHTTPServer(('127.0.0.1', port), StatsRequestHandler)
+    print('Serving stats for', storage_filepath, 'at http://127.0.0.1:' + str(port) + '/ (Ctrl-C to stop)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stats service stopped.')
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 8765)
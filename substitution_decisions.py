@@ -0,0 +1,34 @@
+import os
+import pandas as pd
+from file_storage import atomic_to_csv
+from run_journal import fingerprint
+
+# substitution_decisions.csv remembers, for each (recently played track, dynamic playlist track) pair, the similarity
+# scores computed by infer_updated_track_ids and the user's accept/reject answer. Known pairs are neither
+# re-scored nor asked about again. Each side's metadata is hashed, so a pair is scored again if either track's
+# name, artist, album or duration changes.
+decisions_filename = 'substitution_decisions.csv'
+decision_columns = ['recent_track_id', 'playlist_track_id', 'recent_hash', 'playlist_hash', 'name_score',
+                    'artist_score', 'album_score', 'duration_match_pct', 'decision']
+score_columns = ['name_score', 'artist_score', 'album_score', 'duration_match_pct']
+
+
+def track_metadata_hash(track_name, artist_name, album_name, duration_ms):
+    return fingerprint(track_name, artist_name, album_name, duration_ms)[:16]
+
+
+def read_substitution_decisions(storage_filepath):
+    # Returns {(recent_track_id, playlist_track_id): row dict}.
+    decisions_file = os.path.join(storage_filepath, decisions_filename)
+    if not os.path.exists(decisions_file):
+        return {}
+    # Ids, hashes and an undecided (blank) decision are read as text; blank scores (e.g. a song without a duration)
+    # are read back as NaN so they still compare as numbers.
+    decisions_df = pd.read_csv(decisions_file, keep_default_na=False, dtype={'recent_hash': str, 'playlist_hash': str})
+    decisions_df[score_columns] = decisions_df[score_columns].apply(pd.to_numeric, errors='coerce')
+    return {(row['recent_track_id'], row['playlist_track_id']): row for row in decisions_df.to_dict('records')}
+
+
+def write_substitution_decisions(storage_filepath, decisions):
+    decisions_df = pd.DataFrame(list(decisions.values()), columns=decision_columns)
+    atomic_to_csv(decisions_df, os.path.join(storage_filepath, decisions_filename))
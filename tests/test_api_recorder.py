@@ -0,0 +1,30 @@
+import pytest
+import api_recorder
+
+
+class FakeSpotify:
+    def playlist_tracks(self, playlist_id):
+        return {'items': [playlist_id + ' song'], 'next': None}
+
+    def current_user_recently_played(self, limit=50, before=None):
+        return {'items': ['recent ' + str(before)], 'next': None}
+
+
+def record(storage):
+    client = api_recorder.api_client(FakeSpotify(), str(storage), 'record')
+    client.playlist_tracks('playlist_a')
+    client.current_user_recently_played(limit=50, before=1000)
+
+
+def test_replay_answers_time_keyed_requests_with_any_timestamp(tmp_path):
+    record(tmp_path)
+    client = api_recorder.api_client(None, str(tmp_path), 'replay')
+    assert client.playlist_tracks('playlist_a')['items'] == ['playlist_a song']
+    assert client.current_user_recently_played(limit=50, before=2000)['items'] == ['recent 1000']
+
+
+def test_replay_never_answers_with_another_playlist(tmp_path):
+    record(tmp_path)
+    client = api_recorder.api_client(None, str(tmp_path), 'replay')
+    with pytest.raises(api_recorder.ReplayMissingError):
+        client.playlist_tracks('playlist_b')
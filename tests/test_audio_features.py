@@ -0,0 +1,45 @@
+import pandas as pd
+import spotipy
+import audio_features as af
+
+
+class FeaturesEndpoint:
+    # Local stand-in for Spotify's audio-features endpoint.
+    def __init__(self, refuse=False):
+        self.refuse = refuse
+        self.requests = []
+
+    def audio_features(self, track_ids):
+        self.requests.append(list(track_ids))
+        if self.refuse:
+            raise spotipy.SpotifyException(403, -1, 'Forbidden')
+        return [None if track_id == 'no_features' else {'tempo': 100 + len(track_id), 'energy': 0.5}
+                for track_id in track_ids]
+
+
+def write_tracked(storage, track_ids):
+    pd.DataFrame({'track_id': track_ids}).to_csv(storage / 'all_tracked_songs.csv', index=False)
+
+
+def test_features_are_fetched_in_batches_and_cached(tmp_path):
+    write_tracked(tmp_path, ['a', 'bb', 'ccc', 'no_features'])
+    endpoint = FeaturesEndpoint()
+    assert af.update_audio_features(endpoint, str(tmp_path), batch_size=3) == 4
+    assert endpoint.requests == [['a', 'bb', 'ccc'], ['no_features']]
+    features_df = af.read_audio_features(str(tmp_path))
+    assert features_df['tempo'].tolist()[:3] == [101, 102, 103]
+    assert features_df['tempo'].isna().tolist()[3]
+
+    # Steady state: nothing new is tracked, so nothing is requested.
+    assert af.update_audio_features(endpoint, str(tmp_path), batch_size=3) == 0
+    write_tracked(tmp_path, ['a', 'bb', 'ccc', 'no_features', 'dddd'])
+    af.update_audio_features(endpoint, str(tmp_path), batch_size=3)
+    assert endpoint.requests[2:] == [['dddd']]
+
+
+def test_refused_endpoint_is_not_retried_every_run(tmp_path):
+    write_tracked(tmp_path, ['a', 'bb'])
+    endpoint = FeaturesEndpoint(refuse=True)
+    assert af.update_audio_features(endpoint, str(tmp_path)) == 0
+    assert af.update_audio_features(endpoint, str(tmp_path)) == 0
+    assert len(endpoint.requests) == 1
@@ -0,0 +1,44 @@
+import os
+import generations
+
+
+def publish_edit(storage, text):
+    (storage / 'rankings.csv').write_text(text)
+    return generations.publish_generation(str(storage))
+
+
+def test_generation_is_not_changed_by_later_writes(tmp_path):
+    first = publish_edit(tmp_path, 'track_id\nA\n')
+    first_path = generations.current_generation_path(str(tmp_path))
+    os.replace(str(tmp_path / 'rankings.csv'), str(tmp_path / 'old.tmp'))
+    second = publish_edit(tmp_path, 'track_id\nB\n')
+    assert (first, second) == (1, 2)
+    assert open(os.path.join(first_path, 'rankings.csv')).read() == 'track_id\nA\n'
+
+
+def test_previous_generation_is_always_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(generations, 'keep_generations', 1)
+    for version in range(4):
+        (tmp_path / 'rankings.csv').unlink(missing_ok=True)
+        publish_edit(tmp_path, 'track_id\n' + str(version) + '\n')
+    kept = sorted(name for name in os.listdir(generations.generations_path(str(tmp_path))) if name.isdigit())
+    assert kept == ['3', '4']
+
+
+def test_copied_generations_link_unchanged_files_to_the_previous_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(generations, 'link_working_files', False)
+    (tmp_path / 'listen_history.csv').write_text('track_id\nA\n')
+    publish_edit(tmp_path, 'track_id\nA\n')
+    first_path = generations.current_generation_path(str(tmp_path))
+    os.replace(str(tmp_path / 'rankings.csv'), str(tmp_path / 'old.tmp'))
+    publish_edit(tmp_path, 'track_id\nB\n')
+    second_path = generations.current_generation_path(str(tmp_path))
+
+    def inode(*parts):
+        return os.stat(os.path.join(*parts)).st_ino
+    # No generation shares a file with the working copy.
+    for path in (first_path, second_path):
+        for name in ('listen_history.csv', 'rankings.csv'):
+            assert inode(path, name) != inode(str(tmp_path), name)
+    assert inode(first_path, 'listen_history.csv') == inode(second_path, 'listen_history.csv')
+    assert inode(first_path, 'rankings.csv') != inode(second_path, 'rankings.csv')
@@ -0,0 +1,73 @@
+import os
+import random
+import ordering_archive as oa
+
+
+def random_orders(rng, library_size=60):
+    library = ['track%02d' % number for number in range(library_size)]
+    old_order = rng.sample(library, rng.randint(0, library_size))
+    new_order = rng.sample(library, rng.randint(1, library_size))
+    if rng.random() < 0.5:
+        # A small change: a few songs moved, added and removed.
+        new_order = [track_id for track_id in old_order if rng.random() > 0.1] or new_order
+        for track_id in rng.sample(library, 5):
+            if track_id in new_order:
+                new_order.remove(track_id)
+            new_order.insert(rng.randint(0, len(new_order)), track_id)
+    return old_order, new_order
+
+
+def play_calls(order, calls):
+    # Applies edit calls the way Spotify does.
+    order = list(order)
+    for call in calls:
+        if call[0] == 'playlist_remove_all_occurrences_of_items':
+            order = [track_id for track_id in order if track_id not in call[1]]
+        elif call[0] == 'playlist_add_items':
+            order[call[2]:call[2]] = call[1]
+        elif call[0] == 'playlist_reorder_items':
+            track_id = order.pop(call[1])
+            order.insert(call[2] if call[2] < call[1] else call[2] - 1, track_id)
+    return order
+
+
+def test_delta_round_trip():
+    rng = random.Random(1)
+    for _ in range(300):
+        old_order, new_order = random_orders(rng)
+        assert oa.apply_delta(old_order, oa.ordering_delta(old_order, new_order)) == new_order
+
+
+def test_edit_calls_round_trip():
+    rng = random.Random(2)
+    for _ in range(300):
+        current_order, target_order = random_orders(rng)
+        calls, edited_order = oa.edit_calls(current_order, target_order)
+        assert edited_order == target_order
+        assert play_calls(current_order, calls) == target_order
+
+
+def test_archive_round_trip_with_song_numbers(tmp_path, monkeypatch):
+    monkeypatch.setattr(oa, 'snapshot_every', 4)
+    rng = random.Random(3)
+    order = ['track%02d' % number for number in range(30)]
+    recorded = []
+    for run in range(12):
+        if run % 3 == 0:
+            rng.shuffle(order)
+        else:
+            order = order[1:] + ['new%02d' % run]
+        recorded.append(list(order))
+        assert oa.record_ordering(str(tmp_path), 'dynamic_songs', order) == run + 1
+        if run == 6:
+            # A missing or outdated latest-order file is rebuilt from the archive.
+            os.remove(oa.latest_path(str(tmp_path), 'dynamic_songs'))
+
+    # Re-archiving the latest order adds no version.
+    assert oa.record_ordering(str(tmp_path), 'dynamic_songs', order) == 12
+    entries = oa.read_archive(str(tmp_path), 'dynamic_songs')
+    assert [track_order for _, track_order in oa.all_version_orders(entries)] == recorded
+    assert any('delta' in entry for entry in entries)
+    # Every track id is written to the archive once.
+    archive_text = open(oa.archive_path(str(tmp_path), 'dynamic_songs')).read()
+    assert archive_text.count('"track05"') == 1
@@ -0,0 +1,11 @@
+import pandas as pd
+import shuffle_audit
+
+
+def test_position_bias_with_a_song_on_the_playlist_twice():
+    dynamic_df = pd.DataFrame({'track_id': ['A', 'B', 'A', 'C']})
+    history_df = pd.DataFrame({'track_id': ['A', 'C', 'D'], 'meta_batch': 1,
+                               'played_at_timestamp': [1000, 2000, 3000]})
+    result = shuffle_audit.position_bias(history_df, dynamic_df, buckets=4)
+    assert result['plays'] == 2
+    assert result['bucket_counts'] == [1, 0, 0, 1]
@@ -0,0 +1,55 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+import pandas as pd
+import pytest
+import stats_service
+
+
+@pytest.fixture
+def service(tmp_path):
+    pd.DataFrame({'track_id': ['A', 'B', 'C'], 'star_rating': [5, 7, 0]}).to_csv(tmp_path / 'rankings.csv', index=False)
+    write_history(tmp_path, ['A'])
+    stats_service.StatsRequestHandler.store = stats_service.StatsStore(str(tmp_path))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), stats_service.StatsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield tmp_path, 'http://127.0.0.1:' + str(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def write_history(storage, track_ids):
+    played_at = pd.Timestamp.now(tz='UTC').strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    pd.DataFrame({'track_id': track_ids, 'played_at': played_at,
+                  'played_on_tracked_list': True}).to_csv(storage / 'listen_history.csv', index=False)
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_bad_numbers_are_a_400(service):
+    _, url = service
+    assert get(url + '/rankings?limit=abc')[0] == 400
+    assert get(url + '/stats/windows?days=14,x')[0] == 400
+    assert get(url + '/rankings?limit=1') == (200, [{'track_id': 'A', 'star_rating': 5}])
+
+
+def test_unknown_star_ratings_are_skipped(service):
+    _, url = service
+    status, summary = get(url + '/stats/stars')
+    assert status == 200
+    assert [row['star_rating'] for row in summary] == [0, 5]
+
+
+def test_window_counts_follow_history_without_rollup(service):
+    storage, url = service
+    assert [row['track_id'] for row in get(url + '/stats/windows?days=14')[1]] == ['A']
+    write_history(storage, ['A', 'B'])
+    assert sorted(row['track_id'] for row in get(url + '/stats/windows?days=14')[1]) == ['A', 'B']
@@ -0,0 +1,16 @@
+import numpy as np
+import substitution_decisions as sd
+
+
+def test_decisions_round_trip_with_blank_scores(tmp_path):
+    decisions = {('recent', 'playlist'): {'recent_track_id': 'recent', 'playlist_track_id': 'playlist',
+                                          'recent_hash': '0123456789abcdef', 'playlist_hash': '1e10000000000000',
+                                          'name_score': 0.9, 'artist_score': 1.0, 'album_score': np.nan,
+                                          'duration_match_pct': np.nan, 'decision': ''}}
+    sd.write_substitution_decisions(str(tmp_path), decisions)
+    known = sd.read_substitution_decisions(str(tmp_path))[('recent', 'playlist')]
+    assert known['playlist_hash'] == '1e10000000000000'
+    assert known['decision'] == ''
+    assert known['name_score'] > 0.8
+    assert not known['album_score'] > 0.4
+    assert not known['duration_match_pct'] < 0.05
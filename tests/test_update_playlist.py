@@ -0,0 +1,36 @@
+import builtins
+import pandas as pd
+import spotify_functions as sf
+
+
+class FakeSpotify:
+    def __init__(self):
+        self.loaded = []
+
+    def playlist_replace_items(self, playlist_id, track_ids):
+        self.loaded = list(track_ids)
+
+    def playlist_add_items(self, playlist_id, track_ids):
+        self.loaded.extend(track_ids)
+
+
+def test_duration_playlist_follows_priority_with_tempo_curve(tmp_path, monkeypatch):
+    sf.local_storage_init(str(tmp_path))
+    track_ids = ['T' + str(number) for number in range(20)]
+    pd.DataFrame({'album_id': 'album', 'album_name': 'Album', 'artist_id': 'artist',
+                  'artist_name': ['Artist ' + track_id for track_id in track_ids], 'track_id': track_ids,
+                  'track_name': ['Song ' + track_id for track_id in track_ids], 'popularity': 1,
+                  'duration_ms': 180000}).to_csv(tmp_path / 'all_tracked_songs.csv', index=False)
+    pd.DataFrame({'track_id': track_ids, 'tempo': range(190, 170, -1),
+                  'energy': [number / 20 for number in range(20)]}).to_csv(tmp_path / 'audio_features.csv',
+                                                                           index=False)
+    (tmp_path / 'tempo_run.txt').write_text('tempo_run_id')
+    monkeypatch.setattr(builtins, 'input', lambda prompt='': '3')
+    sf.update_rankings(str(tmp_path), False, tempo_curve_songs=10)
+
+    rankings_df = pd.read_csv(tmp_path / 'rankings.csv')
+    assert rankings_df['track_id'].tolist() != rankings_df.sort_values('priority')['track_id'].tolist()
+
+    sp = FakeSpotify()
+    sf.update_playlist(sp, str(tmp_path), 'tempo_run', target_minutes=15)
+    assert sp.loaded == rankings_df.sort_values('priority')['track_id'].tolist()[:5]
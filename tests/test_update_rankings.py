@@ -0,0 +1,97 @@
+import builtins
+import pandas as pd
+import pytest
+import spotify_functions as sf
+
+
+def write_tracked(storage, track_ids):
+    pd.DataFrame({'album_id': ['album_' + track_id for track_id in track_ids],
+                  'album_name': 'Album',
+                  'artist_id': 'artist',
+                  'artist_name': ['Artist ' + track_id for track_id in track_ids],
+                  'track_id': track_ids,
+                  'track_name': ['Song ' + track_id for track_id in track_ids],
+                  'popularity': 1,
+                  'duration_ms': 200000}).to_csv(storage / 'all_tracked_songs.csv', index=False)
+
+
+def answer_prompts(monkeypatch, answers):
+    answers = iter(answers)
+    monkeypatch.setattr(builtins, 'input', lambda prompt='': next(answers, ''))
+
+
+def rankings(storage):
+    return dict(pd.read_csv(storage / 'rankings.csv')[['track_id', 'star_rating']].values.tolist())
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    sf.local_storage_init(str(tmp_path))
+    write_tracked(tmp_path, ['A', 'B', 'C'])
+    answer_prompts(monkeypatch, ['4', '3', '2'])
+    sf.update_rankings(str(tmp_path), False)
+    return tmp_path
+
+
+def test_new_track_added_to_existing_rankings(storage, monkeypatch):
+    write_tracked(storage, ['A', 'B', 'C', 'D'])
+    answer_prompts(monkeypatch, ['5'])
+    sf.update_rankings(str(storage), False)
+    assert rankings(storage) == {'A': 4, 'B': 3, 'C': 2, 'D': 5}
+
+
+def test_readded_track_keeps_rating_after_interrupted_run(storage, monkeypatch):
+    write_tracked(storage, ['A', 'C'])
+    sf.update_rankings(str(storage), False)
+    assert 'B' not in rankings(storage)
+
+    # The run that re-adds B is stopped at the rating prompt, before rankings.csv is written.
+    def interrupt(prompt=''):
+        raise KeyboardInterrupt
+    write_tracked(storage, ['A', 'B', 'C', 'D'])
+    monkeypatch.setattr(builtins, 'input', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        sf.update_rankings(str(storage), False)
+
+    answer_prompts(monkeypatch, ['5'])
+    sf.update_rankings(str(storage), False)
+    assert rankings(storage) == {'A': 4, 'B': 3, 'C': 2, 'D': 5}
+
+
+def test_artist_spacing_keeps_tempo_curve(tmp_path, monkeypatch):
+    sf.local_storage_init(str(tmp_path))
+    track_ids = list('ABCDEFGH')
+    write_tracked(tmp_path, track_ids)
+    tracked_df = pd.read_csv(tmp_path / 'all_tracked_songs.csv')
+    tracked_df['artist_name'] = ['Artist 1', 'Artist 2', 'Artist 3', 'Artist 4'] * 2
+    tracked_df.to_csv(tmp_path / 'all_tracked_songs.csv', index=False)
+    features_df = pd.DataFrame({'track_id': track_ids,
+                                'tempo': [150, 180, 120, 175, 160, 130, 170, 140],
+                                'energy': [0.5, 0.9, 0.2, 0.8, 0.6, 0.3, 0.7, 0.4]})
+    features_df.to_csv(tmp_path / 'audio_features.csv', index=False)
+    answer_prompts(monkeypatch, ['3'] * len(track_ids))
+
+    sf.update_rankings(str(tmp_path), False, tempo_curve_songs=5, artist_gap=1)
+    top_df = pd.read_csv(tmp_path / 'rankings.csv').head(5)
+    # No two songs by the same artist next to each other.
+    assert (top_df['artist_name'] != top_df['artist_name'].shift()).all()
+    # One warm-up song (the slowest of the five) and one finish song (the most energetic of the rest), which the
+    # gap may move one place forward.
+    assert top_df['tempo'].iloc[0] == top_df['tempo'].min()
+    assert top_df['energy'].iloc[-2:].max() == top_df['energy'].iloc[1:].max()
+
+
+def test_history_changed_outside_the_script_reaches_the_rankings(storage, monkeypatch):
+    history_df = pd.read_csv(storage / 'listen_history.csv')
+    played_at = pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=3)
+    imported = pd.DataFrame({'track_name': ['Song C'], 'artist_name': ['Artist C'], 'album_name': ['Album'],
+                             'played_at': [played_at.strftime('%Y-%m-%dT%H:%M:%S.000Z')],
+                             'played_at_timestamp': [int(played_at.timestamp() * 1000)], 'duration_ms': [200000],
+                             'track_id': ['C'], 'played_on_tracked_list': [True]})
+    pd.concat([history_df, imported]).to_csv(storage / 'listen_history.csv', index=False)
+
+    answer_prompts(monkeypatch, [])
+    sf.update_rankings(str(storage), False)
+    rankings_df = pd.read_csv(storage / 'rankings.csv').set_index('track_id')
+    assert rankings_df.loc['C', 'star_plays'] == 1
+    assert rankings_df.loc['A', 'star_plays'] == 0
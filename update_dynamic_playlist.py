@@ -1,4 +1,9 @@
 import spotify_functions as sf
+import run_journal as rj
+import audio_features as af
+import stage_profiler
+import api_recorder
+import generations
 #####################################################################################################
 # To use this script, you must first create an application and obtain the client id & secret tokens
 # from developer.spotify.com.
@@ -6,6 +11,8 @@ import spotify_functions as sf
 # Update with the file directory where you'd like your credentials saved and your local files stored.
 credential_location = 'C:/Users/rickb/PycharmProjects/credentials/'
 local_file_storage_location = 'C:/Users/rickb/PycharmProjects/spotify_file_storage/'
+# Only one run at a time may update the storage location. Readers use the published generations, see generations.py.
+pipeline_lock = generations.acquire_pipeline_lock(local_file_storage_location)
 sf.local_initialization_check(credential_location, local_file_storage_location)
 # if the above locations do not exist, they will be created by the above function.
 #####################################################################################################
@@ -22,25 +29,78 @@ count_tracked_plays_only = True
 # and the tracked playlist. Thus, it will be imperfect, especially if you are listening with shuffle enabled.
 # a True value will discount any plays from the listening history that don't seem to be from the tracked playlist
 # a False value will include all plays of a song regardless of source playlist.
+dynamic_playlist_size = 50
+# dynamic_playlist_size is the number of top-ranked songs loaded onto the dynamic playlist.
+duration_playlists = {}
+# duration_playlists builds additional playlists filled to a target length in minutes, in ranking order, e.g.
+# {'tempo_run_45': 45, 'long_run_120': 120}. You'll be asked for each playlist's id the first time.
+tempo_curve = False
+# tempo_curve uses each song's tempo & energy (downloaded once and cached locally) to order the dynamic playlist
+# like a run: slower songs to warm up, a steady middle, and the highest-energy songs to finish.
+# a False value leaves the dynamic playlist in pure ranking order.
+artist_gap = 0
+album_gap = 0
+# artist_gap keeps at least this many other songs between two songs by the same artist, and album_gap between two
+# songs from the same album, moving songs as little as possible from their ranked position. 0 turns either off.
+# With tempo_curve on, the warm-up and finish songs are then ordered by tempo and energy instead.
+merge_chunk_size = None
+# merge_chunk_size merges new plays into the listening history file in a streaming pass of this many rows at a time
+# (e.g. 100000), instead of loading the whole history into memory. Useful for very long histories on small machines.
+# None merges in memory.
+profile_stages = False
+# profile_stages records CPU (cProfile) and memory (tracemalloc) profiles for each step into a 'profiles' folder
+# in the local storage location, and prints the slowest functions at the end. Can also be turned on by setting
+# the SPOTIFY_PROFILE environment variable to 1.
+api_mode = None
+# api_mode 'record' saves every Spotify API response of a run (and the playlist changes it made) to an
+# 'api_recordings' folder. 'replay' then re-runs the whole script offline from that recording, without logging in:
+# playlist changes are saved to api_recordings/captured_writes.jsonl instead of being sent. Best used on a copy
+# of the local storage location, since the local files are still updated. 'ttl' re-uses read responses younger
+# than api_ttl_seconds, for quick repeated runs while developing. None talks to Spotify directly.
+api_ttl_seconds = 3600
 #####################################################################################################
 
 
-client = sf.spotify_login(credential_location)
-sf.synchronize_playlist(client, local_file_storage_location, 'all_tracked_songs')
-sf.synchronize_playlist(client, local_file_storage_location, 'dynamic_songs')
-recent_count = sf.get_recently_played(client, local_file_storage_location, count_tracked_plays_only)
+# Each stage is recorded in a run journal. If the script stops part-way through, the next execution resumes at
+# the first unfinished stage instead of starting over.
+if profile_stages:
+    stage_profiler.enable_profiling()
+rj.start_run(local_file_storage_location)
+client = sf.spotify_login(credential_location) if api_mode != 'replay' else None
+client = api_recorder.api_client(client, local_file_storage_location, api_mode, api_ttl_seconds)
+rj.run_stage(local_file_storage_location, 'sync_all_tracked_songs',
+             sf.synchronize_playlist, client, local_file_storage_location, 'all_tracked_songs')
+rj.run_stage(local_file_storage_location, 'sync_dynamic_songs',
+             sf.synchronize_playlist, client, local_file_storage_location, 'dynamic_songs')
+for playlist_name in duration_playlists:
+    rj.run_stage(local_file_storage_location, 'sync_' + playlist_name,
+                 sf.synchronize_playlist, client, local_file_storage_location, playlist_name)
+if tempo_curve:
+    rj.run_stage(local_file_storage_location, 'audio_features',
+                 af.update_audio_features, client, local_file_storage_location)
+recent_count = rj.run_stage(local_file_storage_location, 'recently_played',
+                            sf.get_recently_played, client, local_file_storage_location, count_tracked_plays_only)
 
 if recent_count > 0:
-    sf.infer_updated_track_ids(local_file_storage_location, 0.8)
-    sf.infer_history(local_file_storage_location, shuffle_off)
-    sf.merge_play_history(local_file_storage_location)
-
-sf.update_rankings(local_file_storage_location, count_tracked_plays_only)
-sf.update_playlist(client, local_file_storage_location, 'all_tracked_songs')
-sf.update_playlist(client, local_file_storage_location, 'dynamic_songs', 50)
-
-
-
-
-
+    rj.run_stage(local_file_storage_location, 'infer_track_ids',
+                 sf.infer_updated_track_ids, local_file_storage_location, 0.8)
+    rj.run_stage(local_file_storage_location, 'infer_history',
+                 sf.infer_history, local_file_storage_location, shuffle_off)
+    rj.run_stage(local_file_storage_location, 'merge_history',
+                 sf.merge_play_history, local_file_storage_location, merge_chunk_size)
 
+rj.run_stage(local_file_storage_location, 'update_rankings',
+             sf.update_rankings, local_file_storage_location, count_tracked_plays_only,
+             tempo_curve_songs=dynamic_playlist_size if tempo_curve else None,
+             artist_gap=artist_gap, album_gap=album_gap)
+rj.run_stage(local_file_storage_location, 'update_all_tracked_songs',
+             sf.update_playlist, client, local_file_storage_location, 'all_tracked_songs')
+rj.run_stage(local_file_storage_location, 'update_dynamic_songs',
+             sf.update_playlist, client, local_file_storage_location, 'dynamic_songs', dynamic_playlist_size)
+for playlist_name, target_minutes in duration_playlists.items():
+    rj.run_stage(local_file_storage_location, 'update_' + playlist_name,
+                 sf.update_playlist, client, local_file_storage_location, playlist_name,
+                 target_minutes=target_minutes)
+rj.finish_run(local_file_storage_location)
+generations.release_pipeline_lock(pipeline_lock)
+stage_profiler.print_profile_summary()